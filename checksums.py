@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+"""
+File checksums
+Контрольные суммы файлов: изображения, выгружаемые таблицы и файлы на Google Drive
+"""
+
+import hashlib
+
+def file_md5(path: str) -> str:
+    """MD5 of a file, read in 1 MB chunks (same value as Drive's md5Checksum)"""
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
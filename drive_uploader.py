@@ -10,6 +10,8 @@ from googleapiclient.http import MediaFileUpload
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
 
+from checksums import file_md5
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -89,10 +91,19 @@ class DriveUploader:
             else:
                 filename = os.path.basename(local_path)
             
+            # Одинаковые изображения загружаются один раз: ищем файл с тем же MD5
+            digest = file_md5(local_path)
+            existing = self.find_image(digest)
+            if existing:
+                public_url = f"https://drive.google.com/uc?id={existing}"
+                logger.info(f"✅ Reusing uploaded copy of {filename}: {public_url}")
+                return public_url
+            
             # Метаданные файла
             file_metadata = {
                 'name': filename,
-                'parents': [self.folder_id]
+                'parents': [self.folder_id],
+                'appProperties': {'md5': digest}
             }
             
             # Определяем MIME тип
@@ -129,6 +140,14 @@ class DriveUploader:
             logger.error(f"❌ Error uploading image {local_path}: {e}")
             raise
     
+    def find_image(self, digest):
+        """ID уже загруженного изображения с этим MD5 или None"""
+        query = (f"'{self.folder_id}' in parents and trashed=false "
+                 f"and appProperties has {{ key='md5' and value='{digest}' }}")
+        results = self.drive_service.files().list(q=query, fields="files(id)", pageSize=1).execute()
+        files = results.get('files', [])
+        return files[0]['id'] if files else None
+    
     def delete_image(self, file_id):
         """
         Удаление изображения из Google Drive
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Excel file helpers
+Запись Excel файлов; функции без побочных эффектов при импорте, чтобы их можно было запускать в пуле процессов
+"""
+
+import os
+from typing import Optional
+import openpyxl
+import pandas as pd
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+from openpyxl.utils import get_column_letter
+
+from checksums import file_md5
+
+# Header style of pandas 2.x DataFrame.to_excel, kept regardless of the installed pandas
+HEADER_FONT = Font(bold=True)
+HEADER_BORDER = Border(left=Side(style='thin'), right=Side(style='thin'),
+                       top=Side(style='thin'), bottom=Side(style='thin'))
+HEADER_ALIGNMENT = Alignment(horizontal='center', vertical='top')
+
+MAX_COLUMN_WIDTH = 50  # characters
+
+def _cell_value(value):
+    """DataFrame value as something openpyxl can store (NaN/NaT -> empty cell)"""
+    if value is None:
+        return None
+    try:
+        if pd.isna(value):
+            return None
+    except (TypeError, ValueError):
+        pass
+    if hasattr(value, 'item') and not isinstance(value, pd.Timestamp):  # numpy scalars
+        return value.item()
+    return value
+
+def write_excel(df: pd.DataFrame, excel_file_path: str):
+    """Write a DataFrame to an .xlsx file atomically, with columns sized to fit.
+
+    Widths are computed from the data before anything is written, and the
+    sheet is streamed in openpyxl write-only mode, so the file is produced in
+    a single pass without reopening it. It is written next to the target and
+    moved into place, so an upload that already opened the old file never
+    sees a partial write.
+    """
+    headers = [str(col) for col in df.columns]
+    widths = [len(header) for header in headers]
+    rows = []
+    for record in df.itertuples(index=False, name=None):
+        row = [_cell_value(value) for value in record]
+        for col, value in enumerate(row):
+            if value:
+                widths[col] = max(widths[col], len(str(value)))
+        rows.append(row)
+
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Sheet1')
+    for col, width in enumerate(widths, start=1):
+        # Column dimensions must be set before the first row is written
+        worksheet.column_dimensions[get_column_letter(col)].width = min(width + 2, MAX_COLUMN_WIDTH)
+
+    header_cells = []
+    for header in headers:
+        cell = WriteOnlyCell(worksheet, value=header)
+        cell.font = HEADER_FONT
+        cell.border = HEADER_BORDER
+        cell.alignment = HEADER_ALIGNMENT
+        header_cells.append(cell)
+    worksheet.append(header_cells)
+    for row in rows:
+        worksheet.append(row)
+
+    base, ext = os.path.splitext(excel_file_path)
+    tmp_path = f"{base}.tmp{ext}"
+    try:
+        workbook.save(tmp_path)
+        os.replace(tmp_path, excel_file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def workbook_stamp(excel_file_path: str) -> Optional[str]:
+    """MD5 of the file contents (same value as Drive's md5Checksum), or None if it does not exist"""
+    if not os.path.exists(excel_file_path):
+        return None
+    return file_md5(excel_file_path)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Executor layer for blocking work
+Выполнение блокирующих операций (Google API, pandas, openpyxl) вне цикла asyncio
+"""
+
+import os
+import asyncio
+import logging
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Bounded pools: Render's free plan has one CPU and 512 MB of RAM
+IO_WORKERS = int(os.getenv('IO_WORKERS', '4'))
+CPU_WORKERS = int(os.getenv('CPU_WORKERS', '1'))
+
+# Default per-call deadlines
+IO_TIMEOUT_SECONDS = float(os.getenv('IO_TIMEOUT_SECONDS', '60'))
+CPU_TIMEOUT_SECONDS = float(os.getenv('CPU_TIMEOUT_SECONDS', '120'))
+
+_io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='io')
+_cpu_pool = None
+_cpu_lock = threading.Lock()  # the pool is created and replaced from several threads
+_cpu_closed = False  # set by shutdown(): later calls run in-process
+
+def _get_cpu_pool(fork: bool = False):
+    """Create the process pool on first use.
+
+    Only warm_up(), which runs before the bot and the image server start
+    their threads, forks the workers: 'fork' is cheap and does not re-import
+    the main module. A pool created later (no warm-up, or a replacement for
+    a broken one) uses 'spawn', since forking while other threads hold locks
+    can leave those locks held forever in the child. Spawned workers re-run
+    the main script as __mp_main__, so telegram_bot.py skips its start-up there.
+    """
+    global _cpu_pool
+    with _cpu_lock:
+        if _cpu_pool is None and not _cpu_closed:
+            method = 'fork' if fork and 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+            _cpu_pool = ProcessPoolExecutor(
+                max_workers=CPU_WORKERS,
+                mp_context=multiprocessing.get_context(method)
+            )
+        return _cpu_pool
+
+def _noop():
+    return None
+
+def warm_up():
+    """Fork the CPU workers early, before the bot starts its own threads"""
+    try:
+        pool = _get_cpu_pool(fork=True)
+        if pool:
+            pool.submit(_noop).result(timeout=CPU_TIMEOUT_SECONDS)
+            logger.info(f"CPU pool ready ({CPU_WORKERS} worker(s))")
+    except Exception as e:
+        logger.error(f"Error starting CPU pool: {e}")
+
+async def run_io(func, *args, timeout: Optional[float] = IO_TIMEOUT_SECONDS, **kwargs):
+    """Await a blocking I/O call (network, disk) in the thread pool.
+
+    Raises asyncio.TimeoutError when the deadline passes, so a hung request
+    frees the handler even if the worker thread is still waiting. Store
+    writes pass timeout=None: an abandoned call is not cancelled, it still
+    commits later, so the handler has to wait for its real result.
+    """
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+    return await asyncio.wait_for(loop.run_in_executor(_io_pool, call), timeout=timeout)
+
+def call_cpu(func, *args, timeout: float = CPU_TIMEOUT_SECONDS, **kwargs):
+    """Run a CPU-heavy call in the process pool and wait for it (func and its arguments must be picklable).
+
+    Called from worker threads (run_io, the sync worker, the image server),
+    never from the event loop.
+    """
+    pool = _get_cpu_pool()
+    if pool is None:
+        return func(*args, **kwargs)
+    try:
+        future = pool.submit(func, *args, **kwargs)
+    except Exception as e:
+        # Broken pool (e.g. a worker was killed by the OOM killer): do the work here
+        logger.error(f"CPU pool unavailable, running in-process: {e}")
+        _reset_cpu_pool(pool)
+        return func(*args, **kwargs)
+    return future.result(timeout=timeout)
+
+def _reset_cpu_pool(broken):
+    """Drop a broken pool; the next call creates a new one (unless another thread already did)"""
+    global _cpu_pool
+    with _cpu_lock:
+        if _cpu_pool is broken:
+            _cpu_pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def shutdown(wait: bool = True):
+    """Stop both pools"""
+    global _cpu_pool, _cpu_closed
+    _io_pool.shutdown(wait=wait, cancel_futures=not wait)
+    with _cpu_lock:
+        pool, _cpu_pool, _cpu_closed = _cpu_pool, None, True
+    if pool is not None:
+        pool.shutdown(wait=wait, cancel_futures=not wait)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Telegram file_id cache
+Кэш file_id Telegram: повторная отправка фото и файлов без загрузки байтов
+"""
+
+import logging
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class FileIdCache:
+    """file_id values returned by Telegram, keyed by content, persisted in the store.
+
+    Keys are built from what was sent, never from where it came from: the
+    content hash of local images, the URL plus the instrument's stored image
+    hash (or the data version) for remote images and the export checksum for
+    generated workbooks. A changed file therefore gets a new key
+    and is uploaded once more; stale entries are simply never asked for.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._file_ids: Dict[str, str] = store.telegram_file_ids()
+        self._lock = threading.Lock()
+        logger.info(f"Telegram file_id cache: {len(self._file_ids)} entries")
+
+    def get(self, key: str) -> Optional[str]:
+        return self._file_ids.get(key)
+
+    def put(self, key: str, file_id: str):
+        with self._lock:
+            if self._file_ids.get(key) == file_id:
+                return
+            self._file_ids[key] = file_id
+        self.store.put_telegram_file_id(key, file_id)
+
+    def forget(self, key: str):
+        """Drop an entry Telegram no longer accepts"""
+        with self._lock:
+            if self._file_ids.pop(key, None) is None:
+                return
+        self.store.delete_telegram_file_id(key)
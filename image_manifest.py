@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Instrument image manifest
+Индекс изображений инструментов: номер → лучший файл, без проверок диска при каждом просмотре
+"""
+
+import os
+import re
+import logging
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from checksums import file_md5
+
+logger = logging.getLogger(__name__)
+
+IMAGE_NAME = re.compile(r'^image(\d+)\.(png|jpg|jpeg|webp|avif)$', re.IGNORECASE)
+
+# Preferred format first; the first three keep the order the views used to probe in
+FORMAT_PREFERENCE = ('png', 'jpg', 'jpeg', 'webp', 'avif')
+# Formats Telegram accepts as photos
+SENDABLE_FORMATS = frozenset(('png', 'jpg', 'jpeg', 'webp'))
+
+class ImageEntry:
+    """One image file of an instrument"""
+
+    __slots__ = ('number', 'path', 'format', 'size', 'mtime_ns', 'digest')
+
+    def __init__(self, number: int, path: str, format: str, size: int, mtime_ns: int, digest: str):
+        self.number = number
+        self.path = path
+        self.format = format
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.digest = digest
+
+    def __repr__(self):
+        return f"ImageEntry(№{self.number}, {self.path!r}, {self.format}, {self.size} bytes)"
+
+class ImageManifest:
+    """Instrument number -> image, resolved without touching the disk.
+
+    Instruments reference images in the content-addressed store by digest
+    (set_reference); identical pictures share one entry there. Legacy
+    image{N}.* files in the working directory are indexed by refresh() so
+    they can be migrated into the store. Files are only re-hashed when their
+    size or modification time changed, so refresh() is cheap to call again.
+    Optimized variants from the ingest pipeline are tracked by digest and
+    preferred when present.
+    """
+
+    def __init__(self, directory: str = '.'):
+        self.directory = directory
+        self._files: Dict[int, List[ImageEntry]] = {}  # legacy image{N}.* files, best first
+        self._refs: Dict[int, ImageEntry] = {}  # instrument number -> stored image
+        self._variants: Dict[str, Dict[str, str]] = {}  # source digest -> {variant: path}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._refs.keys() | self._files.keys())
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name) if self.directory != '.' else name
+
+    def _entry(self, name: str, previous: Optional[ImageEntry] = None) -> Optional[ImageEntry]:
+        match = IMAGE_NAME.match(name)
+        if not match:
+            return None
+        path = self._path(name)
+        stat = os.stat(path)
+        if previous and previous.path == path and (previous.size, previous.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            return previous
+        image_format = match.group(2).lower()
+        return ImageEntry(int(match.group(1)), path, image_format, stat.st_size, stat.st_mtime_ns, file_md5(path))
+
+    @staticmethod
+    def _sorted(entries: List[ImageEntry]) -> List[ImageEntry]:
+        return sorted(entries, key=lambda entry: FORMAT_PREFERENCE.index(entry.format))
+
+    def refresh(self) -> int:
+        """Rescan legacy image files, hashing only new or changed ones. Returns the number of instruments found"""
+        previous = {entry.path: entry for entries in self._files.values() for entry in entries}
+        files: Dict[int, List[ImageEntry]] = {}
+        for name in os.listdir(self.directory):
+            try:
+                entry = self._entry(name, previous.get(self._path(name)))
+            except OSError as e:
+                logger.warning(f"Skipping image {name}: {e}")
+                continue
+            if entry:
+                files.setdefault(entry.number, []).append(entry)
+        with self._lock:
+            self._files = {number: self._sorted(items) for number, items in files.items()}
+        logger.info(f"Image manifest: {len(self._files)} legacy image files, {len(self._refs)} stored references")
+        return len(self._files)
+
+    def legacy_entries(self) -> Iterator[ImageEntry]:
+        """Best legacy file of every instrument that has one"""
+        for items in list(self._files.values()):
+            if items:
+                yield items[0]
+
+    def reference(self, number) -> Optional[ImageEntry]:
+        return self._refs.get(int(number))
+
+    def set_reference(self, entry: ImageEntry):
+        """Point an instrument at an image in the content-addressed store"""
+        with self._lock:
+            self._refs = {**self._refs, entry.number: entry}
+
+    def remove_reference(self, number):
+        with self._lock:
+            if int(number) in self._refs:
+                refs = dict(self._refs)
+                del refs[int(number)]
+                self._refs = refs
+
+    def entries(self) -> Iterator[ImageEntry]:
+        """One stored image per unique digest"""
+        seen = set()
+        for entry in list(self._refs.values()):
+            if entry.digest not in seen:
+                seen.add(entry.digest)
+                yield entry
+
+    def set_variants(self, digest: str, paths: Dict[str, str]):
+        """Record optimized variants of the source image with this digest"""
+        with self._lock:
+            self._variants = {**self._variants, digest: dict(paths)}
+
+    def has_variants(self, digest: str, names: Iterable[str]) -> bool:
+        """True when every named variant of this source image is known"""
+        paths = self._variants.get(digest, {})
+        return all(name in paths for name in names)
+
+    def _displayable(self, entry: ImageEntry) -> bool:
+        return entry.format in SENDABLE_FORMATS or 'telegram' in self._variants.get(entry.digest, {})
+
+    def get(self, number) -> Optional[ImageEntry]:
+        """Best image of an instrument that Telegram can display (as is or through a variant), or None"""
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            return None
+        candidates = []
+        if number in self._refs:
+            candidates.append(self._refs[number])
+        candidates.extend(self._files.get(number, ()))
+        for entry in candidates:
+            if self._displayable(entry):
+                return entry
+        return None
+
+    def variant(self, number, variant: str) -> Optional[Tuple[str, str]]:
+        """(path, cache key) of an instrument's image variant, falling back to the original file.
+
+        The cache key names the exact bytes of the file, for the Telegram
+        file_id cache.
+        """
+        entry = self.get(number)
+        if entry is None:
+            return None
+        path = self._variants.get(entry.digest, {}).get(variant)
+        if path:
+            return path, f"{variant}:md5:{entry.digest}"
+        if entry.format not in SENDABLE_FORMATS:
+            return None
+        return entry.path, f"original:md5:{entry.digest}"
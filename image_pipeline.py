@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Image ingest pipeline
+Нормализация изображений при загрузке: оптимизированный вариант для Telegram и уменьшенные копии по запросу
+"""
+
+import io
+import os
+import shutil
+import logging
+from typing import Dict, Optional
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional: without it the original files are served
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Content-addressed by the MD5 of the source image:
+# media/ab/abcdef....png is the original, media/ab/abcdef...-telegram.jpg a variant
+MEDIA_DIR = os.getenv('MEDIA_DIR', 'media')
+
+# variant -> (longest side in px, Pillow format, file extension, quality)
+# Smaller sizes (inline thumbnails, the web grid) are resized on request by the image server
+VARIANTS = {
+    'telegram': (1280, 'JPEG', 'jpg', 85),  # Telegram downscales photos to 1280 px anyway
+}
+
+# On-demand resizes for the image server: format name -> (Pillow format, file extension, quality)
+RESIZE_FORMATS = {
+    'webp': ('WEBP', 'webp', 80),
+    'jpeg': ('JPEG', 'jpg', 82),
+    'png': ('PNG', 'png', None),
+    'avif': ('AVIF', 'avif', 60),
+}
+
+def available() -> bool:
+    return Image is not None
+
+def blob_path(digest: str, image_format: str) -> str:
+    """Path of an original image in the content-addressed store"""
+    return os.path.join(MEDIA_DIR, digest[:2], f"{digest}.{image_format}")
+
+def store_blob(source_path: str, digest: str, image_format: str, move: bool = False) -> str:
+    """Put an original image into the store once per unique content; returns its blob path.
+
+    Existing files are hard-linked when possible, so migrating them costs no
+    disk space; with move=True the source (a fresh download) is moved in.
+    """
+    path = blob_path(digest, image_format)
+    if os.path.exists(path):
+        if move:
+            os.remove(source_path)
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if move:
+        os.replace(source_path, path)
+        return path
+    try:
+        os.link(source_path, path)
+    except OSError:
+        base, extension = os.path.splitext(path)
+        tmp_path = f"{base}.tmp{extension}"
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, path)
+    return path
+
+def sniff_format(path: str) -> Optional[str]:
+    """Image format from the file's magic bytes (png, jpg, webp, avif) or None"""
+    with open(path, 'rb') as f:
+        header = f.read(16)
+    if header.startswith(b'\x89PNG'):
+        return 'png'
+    if header.startswith(b'\xff\xd8'):
+        return 'jpg'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    if header[4:8] == b'ftyp' and header[8:12] in (b'avif', b'avis'):
+        return 'avif'
+    return None
+
+def _has_alpha(image) -> bool:
+    return image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+
+def _flatten(image):
+    """RGB copy of an image; JPEG has no alpha, so transparent images are flattened onto white"""
+    if not _has_alpha(image):
+        return image.convert('RGB')
+    rgba = image.convert('RGBA')
+    flat = Image.new('RGB', rgba.size, (255, 255, 255))
+    flat.paste(rgba, mask=rgba.getchannel('A'))
+    return flat
+
+def can_encode(format_name: str) -> bool:
+    """True when this Pillow build can write the resize format (AVIF needs Pillow 11.3+)"""
+    if Image is None or format_name not in RESIZE_FORMATS:
+        return False
+    Image.init()
+    return RESIZE_FORMATS[format_name][0] in Image.SAVE
+
+def resize_image(source_path: str, width: int, format_name: str) -> bytes:
+    """Encode one image scaled down to width pixels (never up); returns the file bytes.
+
+    Runs in the CPU process pool on behalf of the image server.
+    """
+    image_format, _, quality = RESIZE_FORMATS[format_name]
+    with Image.open(source_path) as opened:
+        image = ImageOps.exif_transpose(opened)
+        if image_format == 'JPEG':
+            image = _flatten(image)
+        else:
+            image = image.convert('RGBA' if _has_alpha(image) else 'RGB')
+        if image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+        buffer = io.BytesIO()
+        options = {'optimize': True} if quality is None else {'quality': quality}
+        image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+def variant_path(digest: str, variant: str) -> str:
+    extension = VARIANTS[variant][2]
+    return os.path.join(MEDIA_DIR, digest[:2], f"{digest}-{variant}.{extension}")
+
+def normalize_image(source_path: str, digest: str) -> Dict[str, str]:
+    """Write every missing variant of one image; returns variant -> path.
+
+    Runs in the CPU process pool. Variants are content-addressed, so calling
+    this again for the same image only checks that the files exist.
+    """
+    paths = {variant: variant_path(digest, variant) for variant in VARIANTS}
+    missing = [variant for variant, path in paths.items() if not os.path.exists(path)]
+    if not missing:
+        return paths
+
+    with Image.open(source_path) as opened:
+        image = _flatten(ImageOps.exif_transpose(opened))
+
+        os.makedirs(os.path.dirname(paths['telegram']), exist_ok=True)
+        for variant in missing:
+            max_side, image_format, _, quality = VARIANTS[variant]
+            resized = image.copy()
+            resized.thumbnail((max_side, max_side), Image.LANCZOS)
+            path = paths[variant]
+            base, extension = os.path.splitext(path)
+            tmp_path = f"{base}.tmp{extension}"
+            try:
+                resized.save(tmp_path, image_format, quality=quality, optimize=True)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    return paths
+
+def scan_media() -> Dict[str, Dict[str, str]]:
+    """Variants already on disk: source digest -> {variant: path}"""
+    found: Dict[str, Dict[str, str]] = {}
+    if not os.path.isdir(MEDIA_DIR):
+        return found
+    for prefix in os.listdir(MEDIA_DIR):
+        folder = os.path.join(MEDIA_DIR, prefix)
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            stem, _ = os.path.splitext(name)
+            digest, _, variant = stem.partition('-')
+            if variant in VARIANTS:
+                found.setdefault(digest, {})[variant] = os.path.join(folder, name)
+    return found
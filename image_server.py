@@ -5,63 +5,521 @@ Public Image Server for Bes Saiman Inventory Bot
 """
 
 import os
+import re
+import sqlite3
 import logging
-from http.server import HTTPServer, SimpleHTTPRequestHandler
-from urllib.parse import urlparse
+import email.utils
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
 import threading
 import time
 
+import executors
+import image_pipeline
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Изображения инструментов хранятся по содержимому (media/ab/<md5>.<ext>), см. image_pipeline
+LOCAL_DB_FILE = os.getenv('LOCAL_DB_FILE', 'inventory.db')
+MEDIA_DIR = os.getenv('MEDIA_DIR', 'media')
+# Уменьшенные копии (?w=320&fmt=webp): ширина округляется вверх до ступени, чтобы кэш был ограничен
+RESIZE_DIR = os.path.join(MEDIA_DIR, 'resized')
+RESIZE_WIDTHS = (80, 160, 200, 320, 400, 640, 800, 1280)
+RESIZE_MEMORY_BYTES = int(os.getenv('RESIZE_MEMORY_MB', '16')) * 1024 * 1024
+RESIZE_DISK_BYTES = int(os.getenv('RESIZE_DISK_MB', '128')) * 1024 * 1024
+IMAGE_PATH = re.compile(r'^/image(\d+)\.(png|jpg|jpeg)$', re.IGNORECASE)
+# Самые популярные оригиналы отдаются из памяти; большие файлы всегда идут через sendfile
+HOT_CACHE_BYTES = int(os.getenv('HOT_CACHE_MB', '32')) * 1024 * 1024
+HOT_CACHE_MAX_FILE = 2 * 1024 * 1024
+INDEX_POLL_SECONDS = float(os.getenv('INDEX_POLL_SECONDS', '2'))
+# Рядом с сайтом (index.html, script_v2.js, styles.css) лежат база бота (история, file_id Telegram),
+# исходный код, таблицы и ключи Google: такие файлы не отдаются
+PRIVATE_FILE = re.compile(r'\.(db(-\w+)?|py|pyc|xlsx|json|jsonl|pickle|ya?ml|txt|patch|log)$', re.IGNORECASE)
+PRIVATE_DIRS = {os.path.basename(os.path.normpath(MEDIA_DIR)), '__pycache__'}
+
+# MIME по фактическому формату файла (изображение из хранилища может быть JPEG при URL .png)
+CONTENT_TYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.webp': 'image/webp',
+    '.avif': 'image/avif',
+}
+
+def is_private(path):
+    """Путь к служебному файлу или папке, которые нельзя отдавать наружу"""
+    parts = [part for part in unquote(path).replace('\\', '/').split('/') if part]
+    return any(part.startswith('.') or part in PRIVATE_DIRS for part in parts) or bool(
+        parts and PRIVATE_FILE.search(parts[-1]))
+
+def file_etag(stat):
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+class Asset:
+    """Отдаваемый файл с заранее вычисленными заголовками"""
+    
+    __slots__ = ('path', 'size', 'mtime_ns', 'etag', 'last_modified', 'content_type')
+    
+    def __init__(self, path, stat, content_type):
+        self.path = path
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.etag = file_etag(stat)
+        self.last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        self.content_type = content_type
+
+class AssetIndex:
+    """Индекс изображений: URL /image{N}.* -> файл, без обращений к диску на каждый запрос.
+    
+    Строится при запуске из таблицы instrument_images (хранилище по хешу) и
+    старых файлов image{N}.* в рабочей папке. Фоновый поток раз в
+    INDEX_POLL_SECONDS сверяет mtime папки и базы и перестраивает индекс,
+    когда они изменились.
+    """
+    
+    def __init__(self, directory='.', db_path=LOCAL_DB_FILE, media_dir=MEDIA_DIR):
+        self.directory = directory
+        self.db_path = db_path
+        self.media_dir = media_dir
+        self._stored = {}  # номер инструмента -> Asset из хранилища
+        self._legacy = {}  # имя файла image{N}.* -> Asset
+        self._signature = None
+        self._stop = threading.Event()
+        self.refresh()
+    
+    def _current_signature(self):
+        signature = []
+        for path in (self.directory, self.db_path, f"{self.db_path}-wal"):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+    
+    @staticmethod
+    def _asset(path, fallback_type=None):
+        try:
+            stat = os.stat(path)
+            sniffed = image_pipeline.sniff_format(path)
+        except OSError:
+            return None
+        # Формат по сигнатуре файла: image31.jpeg на деле может оказаться WebP
+        extension = f".{sniffed}" if sniffed else os.path.splitext(path)[1].lower()
+        return Asset(path, stat, CONTENT_TYPES.get(extension, fallback_type or 'application/octet-stream'))
+    
+    def _stored_rows(self):
+        if not os.path.exists(self.db_path):
+            return []
+        try:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            try:
+                return conn.execute('SELECT number, digest, format FROM instrument_images').fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            # База ещё не создана ботом или в ней нет таблицы изображений
+            logger.warning(f"Image store lookup failed: {e}")
+            return []
+    
+    def refresh(self):
+        """Перестроить индекс целиком"""
+        signature = self._current_signature()
+        previous = {asset.path: asset for asset in list(self._stored.values()) + list(self._legacy.values())}
+        
+        def asset(path):
+            # Неизменившиеся файлы не перечитываются
+            old = previous.get(path)
+            if old:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    return None
+                if (stat.st_size, stat.st_mtime_ns) == (old.size, old.mtime_ns):
+                    return old
+            return self._asset(path)
+        
+        stored = {}
+        for number, digest, image_format in self._stored_rows():
+            entry = asset(os.path.join(self.media_dir, digest[:2], f"{digest}.{image_format}"))
+            if entry:
+                stored[number] = entry
+        legacy = {}
+        for name in os.listdir(self.directory):
+            if IMAGE_PATH.match(f"/{name}"):
+                entry = asset(os.path.join(self.directory, name) if self.directory != '.' else name)
+                if entry:
+                    legacy[name] = entry
+        self._stored, self._legacy, self._signature = stored, legacy, signature
+        logger.info(f"Asset index: {len(stored)} stored images, {len(legacy)} legacy files")
+    
+    def refresh_if_changed(self):
+        if self._current_signature() != self._signature:
+            self.refresh()
+    
+    def lookup(self, path):
+        """Asset для URL /image{N}.*: сначала хранилище по хешу, затем старый файл image{N}.*"""
+        match = IMAGE_PATH.match(path)
+        if not match:
+            return None
+        return self._stored.get(int(match.group(1))) or self._legacy.get(path[1:])
+    
+    def names(self):
+        """URL-имена всех изображений, по номеру"""
+        names = {f"image{number}.png" for number in self._stored}
+        names.update(name for name in self._legacy if int(IMAGE_PATH.match(f"/{name}").group(1)) not in self._stored)
+        return sorted(names, key=lambda name: int(IMAGE_PATH.match(f"/{name}").group(1)))
+    
+    def watch(self, interval=INDEX_POLL_SECONDS):
+        """Следить за изменениями в фоновом потоке"""
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.refresh_if_changed()
+                except Exception as e:
+                    logger.error(f"❌ Error refreshing asset index: {e}")
+        threading.Thread(target=loop, name='asset-index', daemon=True).start()
+    
+    def stop(self):
+        self._stop.set()
+
+def parse_range(header, size):
+    """(start, end) включительно для заголовка Range с одним диапазоном; None — отдать файл целиком, False — 416"""
+    units, _, spec = header.partition('=')
+    if units.strip().lower() != 'bytes' or ',' in spec:
+        return None  # несколько диапазонов не поддерживаем: отдаём весь файл
+    first, dash, last = spec.strip().partition('-')
+    if not dash:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # bytes=-N: последние N байт
+            suffix = int(last)
+            if suffix <= 0:
+                return False
+            start, end = max(size - suffix, 0), size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+class ByteLRU:
+    """LRU-словарь, ограниченный суммарным размером значений в байтах"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+    
+    def put(self, key, value, size):
+        """Добавить значение; возвращает вытесненные (key, value)"""
+        evicted = []
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            if size > self.max_bytes:
+                return evicted
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                old_key, (old_value, old_size) = self._items.popitem(last=False)
+                self.size -= old_size
+                evicted.append((old_key, old_value))
+        return evicted
+
+def choose_format(requested, accept, source_path):
+    """Формат уменьшенной копии: явный ?fmt= или лучший из заголовка Accept. Второе значение — зависит ли ответ от Accept"""
+    if requested:
+        requested = 'jpeg' if requested == 'jpg' else requested
+        return (requested if image_pipeline.can_encode(requested) else None), False
+    accept = accept or ''
+    if 'image/webp' in accept:
+        return 'webp', True
+    # Без WebP: прозрачные PNG остаются PNG, остальное — JPEG
+    return ('png' if source_path.lower().endswith('.png') else 'jpeg'), True
+
+class ResizeCache:
+    """Уменьшенные копии изображений: горячие в памяти, остальные на диске, обе части — LRU по байтам.
+    
+    Копия создаётся в пуле процессов executors при первом запросе; параллельные
+    запросы той же копии ждут одного результата.
+    """
+    
+    def __init__(self, directory=RESIZE_DIR, memory_bytes=RESIZE_MEMORY_BYTES, disk_bytes=RESIZE_DISK_BYTES):
+        self.directory = directory
+        self.memory = ByteLRU(memory_bytes)
+        self.disk = ByteLRU(disk_bytes)  # имя файла -> размер, только учёт
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._load_disk_index()
+    
+    def _load_disk_index(self):
+        if not os.path.isdir(self.directory):
+            return
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and '.tmp' not in entry.name:
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        # Самые старые первыми: они же первыми и вытесняются
+        for _, name, size in sorted(files):
+            self._remember_file(name, size)
+        logger.info(f"Resize cache: {len(self.disk)} files, {self.disk.size // 1024} KB on disk")
+    
+    def _remember_file(self, name, size):
+        for old_name, _ in self.disk.put(name, size, size):
+            try:
+                os.remove(os.path.join(self.directory, old_name))
+            except OSError:
+                pass
+    
+    def get(self, source_path, source_tag, width, format_name):
+        """Байты уменьшенной копии; создаёт её при необходимости"""
+        extension = image_pipeline.RESIZE_FORMATS[format_name][1]
+        name = f"{source_tag}-w{width}.{extension}"
+        body = self.memory.get(name)
+        if body is not None:
+            return body
+        
+        with self._lock:
+            future = self._pending.get(name)
+            owner = future is None
+            if owner:
+                future = self._pending[name] = Future()
+        if not owner:
+            return future.result()
+        
+        try:
+            body = self._read(name)
+            if body is None:
+                body = executors.call_cpu(image_pipeline.resize_image, source_path, width, format_name)
+                self._write(name, body)
+            self.memory.put(name, body, len(body))
+            future.set_result(body)
+            return body
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(name, None)
+    
+    def _read(self, name):
+        if self.disk.get(name) is None:
+            return None
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+    
+    def _write(self, name, body):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+        self._remember_file(name, len(body))
+
 class ImageHandler(SimpleHTTPRequestHandler):
-    """Обработчик запросов для изображений"""
+    """Обработчик запросов для изображений.
+    
+    Файл отправляется через sendfile без чтения в память, с ETag и
+    Last-Modified; условные запросы получают 304, Range — 206.
+    """
+    
+    protocol_version = 'HTTP/1.1'  # keep-alive: у каждого ответа есть Content-Length
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=os.getcwd(), **kwargs)
     
     def do_GET(self):
         """Обработка GET запросов"""
+        self.handle_image_request(head_only=False)
+    
+    def do_HEAD(self):
+        """Обработка HEAD запросов"""
+        self.handle_image_request(head_only=True)
+    
+    def handle_image_request(self, head_only):
         try:
             # Парсим URL
             parsed_path = urlparse(self.path)
             path = parsed_path.path
+            query = parse_qs(parsed_path.query)
             
             # Если запрашивается изображение
-            if path.startswith('/image') and (path.endswith('.png') or path.endswith('.jpg') or path.endswith('.jpeg')):
-                # Убираем ведущий слеш
-                image_path = path[1:]
-                
-                if os.path.exists(image_path):
-                    # Отправляем изображение
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'image/png')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.send_header('Cache-Control', 'public, max-age=3600')
-                    self.end_headers()
-                    
-                    with open(image_path, 'rb') as f:
-                        self.wfile.write(f.read())
-                    
-                    logger.info(f"✅ Served image: {image_path}")
-                else:
+            if IMAGE_PATH.match(path):
+                asset = self.server.asset_index.lookup(path)
+                if not asset:
                     # Изображение не найдено
-                    self.send_response(404)
-                    self.send_header('Content-Type', 'text/plain')
-                    self.end_headers()
-                    self.wfile.write(b'Image not found')
-                    logger.warning(f"❌ Image not found: {image_path}")
+                    self.send_text(404, b'Image not found', head_only)
+                    logger.warning(f"❌ Image not found: {path[1:]}")
+                elif 'w' in query:
+                    self.send_resized(asset, query, head_only)
+                else:
+                    self.send_image(asset, head_only)
+            elif is_private(path):
+                self.send_text(404, b'Not found', head_only)
+            elif head_only:
+                super().do_HEAD()
             else:
-                # Обычная обработка файлов
+                # Сайт и прочие файлы из рабочей папки
                 super().do_GET()
-                
+        
+        except FileNotFoundError:
+            # Файл удалён после построения индекса
+            self.server.asset_index.refresh()
+            self.send_text(404, b'Image not found', head_only)
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент закрыл соединение (обычное дело для Range-запросов браузера)
+            self.close_connection = True
         except Exception as e:
             logger.error(f"❌ Error serving request: {e}")
-            self.send_response(500)
-            self.send_header('Content-Type', 'text/plain')
+            self.close_connection = True
+            try:
+                self.send_text(500, b'Internal server error', head_only)
+            except OSError:
+                pass
+    
+    def list_directory(self, path):
+        """Содержимое папок не показывается"""
+        self.send_text(404, b'Not found', self.command == 'HEAD')
+        return None
+    
+    def send_text(self, status, body, head_only=False):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+    
+    def not_modified(self, etag, last_modified):
+        """Условный запрос совпадает с текущей версией ответа"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or f"W/{etag}" in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+                modified = email.utils.parsedate_to_datetime(last_modified)
+            except (TypeError, ValueError):
+                return False
+            return since is not None and modified <= since
+        return False
+    
+    def send_image(self, asset, head_only=False):
+        """Оригинал: горячие файлы из памяти, остальные через sendfile"""
+        body = self.server.hot_cache.get((asset.path, asset.etag))
+        if body is None and asset.size <= HOT_CACHE_MAX_FILE:
+            with open(asset.path, 'rb') as f:
+                body = f.read()
+            self.server.hot_cache.put((asset.path, asset.etag), body, len(body))
+        if body is not None:
+            self.send_entity(body, asset.size, asset.etag, asset.last_modified, asset.content_type, head_only)
+        else:
+            with open(asset.path, 'rb') as f:
+                self.send_entity(f, asset.size, asset.etag, asset.last_modified, asset.content_type, head_only)
+        logger.debug(f"✅ Served image: {asset.path}")
+    
+    def send_resized(self, asset, query, head_only=False):
+        """Уменьшенная копия изображения (?w=320&fmt=webp); без Pillow отдаётся оригинал"""
+        try:
+            width = int(query['w'][0])
+        except ValueError:
+            self.send_text(400, b'Bad width', head_only)
+            return
+        if not image_pipeline.available() or width <= 0:
+            self.send_image(asset, head_only)
+            return
+        requested = query.get('fmt', [''])[0].lower()
+        format_name, negotiated = choose_format(requested, self.headers.get('Accept'), asset.path)
+        if requested and format_name is None:
+            self.send_text(400, b'Unsupported format', head_only)
+            return
+        width = next((step for step in RESIZE_WIDTHS if step >= width), RESIZE_WIDTHS[-1])
+        
+        source_tag = asset.etag.strip('"')
+        extension = image_pipeline.RESIZE_FORMATS[format_name][1]
+        etag = f'"{source_tag}-w{width}.{extension}"'
+        vary = 'Accept' if negotiated else None
+        if self.not_modified(etag, asset.last_modified):
+            # Копию не нужно даже создавать
+            self.send_entity(b'', 0, etag, asset.last_modified, None, head_only, vary)
+            return
+        body = self.server.resize_cache.get(asset.path, source_tag, width, format_name)
+        self.send_entity(body, len(body), etag, asset.last_modified, CONTENT_TYPES[f".{extension}"], head_only, vary)
+    
+    def send_entity(self, body, size, etag, last_modified, content_type, head_only=False, vary=None):
+        """Ответ с валидаторами, 304 и Range; body — открытый файл (sendfile) или bytes"""
+        if self.not_modified(etag, last_modified):
+            self.send_response(304)
+            self.send_entity_headers(etag, last_modified, vary)
+            self.end_headers()
+            return
+        
+        byte_range = None
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header and (not if_range or if_range.strip() in (etag, last_modified)):
+            byte_range = parse_range(range_header, size)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header('Content-Range', f"bytes */{size}")
+            self.send_header('Content-Length', '0')
             self.end_headers()
-            self.wfile.write(b'Internal server error')
+            return
+        
+        start, end = byte_range or (0, size - 1)
+        length = end - start + 1 if size else 0
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(length))
+        if byte_range:
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        self.send_entity_headers(etag, last_modified, vary)
+        self.end_headers()
+        
+        if head_only or not length:
+            return
+        if isinstance(body, bytes):
+            self.wfile.write(memoryview(body)[start:end + 1])
+        else:
+            # Ядро копирует файл прямо в сокет (os.sendfile), без буфера в Python
+            self.connection.sendfile(body, start, length)
+    
+    def send_entity_headers(self, etag, last_modified, vary=None):
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Accept-Ranges', 'bytes')
+        if vary:
+            self.send_header('Vary', vary)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'public, max-age=3600')
     
     def log_message(self, format, *args):
         """Переопределяем логирование"""
@@ -79,7 +537,14 @@ class ImageServer:
     def start(self):
         """Запуск сервера"""
         try:
-            self.server = HTTPServer(('0.0.0.0', self.port), ImageHandler)
+            # Процессы для уменьшения копий создаются (fork) до запуска любых потоков сервера
+            executors.warm_up()
+            # Поток на соединение: медленный клиент не задерживает остальных
+            self.server = ThreadingHTTPServer(('0.0.0.0', self.port), ImageHandler)
+            self.server.asset_index = AssetIndex()
+            self.server.asset_index.watch()
+            self.server.hot_cache = ByteLRU(HOT_CACHE_BYTES)
+            self.server.resize_cache = ResizeCache()
             self.server_thread = threading.Thread(target=self.server.serve_forever)
             self.server_thread.daemon = True
             self.server_thread.start()
@@ -96,6 +561,7 @@ class ImageServer:
     def stop(self):
         """Остановка сервера"""
         if self.server:
+            self.server.asset_index.stop()
             self.server.shutdown()
             self.server.server_close()
             self.running = False
@@ -141,8 +607,7 @@ def main():
         print(f"\n📸 Available images:")
         
         # Показываем доступные изображения
-        image_files = [f for f in os.listdir('.') if f.startswith('image') and f.endswith(('.png', '.jpg', '.jpeg'))]
-        image_files.sort(key=lambda x: int(''.join(filter(str.isdigit, x))))
+        image_files = server.server.asset_index.names()
         
         for img in image_files[:10]:  # Показываем первые 10
             print(f"   • http://{public_ip}:8080/{img}")
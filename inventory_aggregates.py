@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Inventory aggregates
+Сводные показатели инвентаря для статистики и графиков, обновляемые при каждом изменении
+"""
+
+import heapq
+from typing import Dict, List, Tuple
+import numpy as np
+
+# Stock level buckets: low below LOW_STOCK, high above HIGH_STOCK, medium in between (inclusive)
+LOW_STOCK = 5
+HIGH_STOCK = 20
+STOCK_BUCKETS = ("Низкий (<5)", "Средний (5-20)", "Высокий (>20)")
+
+def stock_bucket(quantity: float) -> int:
+    return int(quantity >= LOW_STOCK) + int(quantity > HIGH_STOCK)
+
+class InventoryAggregates:
+    """Instrument count, total quantity, stock buckets and manufacturer counts.
+
+    Kept current in O(1) per add, quantity change and removal; from_table()
+    recomputes everything with NumPy after a bulk load. Manufacturers are
+    counted by their stripped name, blank ones are left out.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_quantity = 0.0
+        self.stock_levels = [0] * len(STOCK_BUCKETS)
+        self.manufacturers: Dict[str, int] = {}  # first-seen order, so ties keep sheet order
+
+    @classmethod
+    def from_table(cls, table) -> 'InventoryAggregates':
+        aggregates = cls()
+        records = table.ordered()
+        quantities = table.live_quantities()
+        aggregates.count = len(records)
+        aggregates.total_quantity = float(quantities.sum())
+        buckets = (quantities >= LOW_STOCK).astype(np.int64) + (quantities > HIGH_STOCK)
+        aggregates.stock_levels = np.bincount(buckets, minlength=len(STOCK_BUCKETS)).tolist()
+
+        names = np.array([record.manufacturer.strip() for record in records], dtype=object)
+        names = names[names != '']
+        if len(names):
+            unique, first, counts = np.unique(names.astype(str), return_index=True, return_counts=True)
+            order = np.argsort(first)
+            aggregates.manufacturers = dict(zip(unique[order].tolist(), counts[order].tolist()))
+        return aggregates
+
+    def add(self, manufacturer: str, quantity: float):
+        self.count += 1
+        self.total_quantity += quantity
+        self.stock_levels[stock_bucket(quantity)] += 1
+        manufacturer = manufacturer.strip()
+        if manufacturer:
+            self.manufacturers[manufacturer] = self.manufacturers.get(manufacturer, 0) + 1
+
+    def remove(self, manufacturer: str, quantity: float):
+        self.count -= 1
+        self.total_quantity -= quantity
+        self.stock_levels[stock_bucket(quantity)] -= 1
+        manufacturer = manufacturer.strip()
+        if manufacturer in self.manufacturers:
+            self.manufacturers[manufacturer] -= 1
+            if not self.manufacturers[manufacturer]:
+                del self.manufacturers[manufacturer]
+
+    def change_quantity(self, old: float, new: float):
+        self.total_quantity += new - old
+        self.stock_levels[stock_bucket(old)] -= 1
+        self.stock_levels[stock_bucket(new)] += 1
+
+    @property
+    def low_stock(self) -> int:
+        return self.stock_levels[0]
+
+    def stock_buckets(self) -> List[Tuple[str, int]]:
+        return list(zip(STOCK_BUCKETS, self.stock_levels))
+
+    def top_manufacturers(self, n: int) -> List[Tuple[str, int]]:
+        """The n manufacturers with most instruments; ties keep first-seen order"""
+        return heapq.nlargest(n, self.manufacturers.items(), key=lambda item: item[1])
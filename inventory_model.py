@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+In-memory instrument model
+Компактное представление инвентаря в памяти: записи со __slots__ и массив количеств
+"""
+
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import numpy as np
+
+from inventory_aggregates import InventoryAggregates
+from search_index import PrefixIndex, SearchIndex
+
+def name_key(name: str) -> str:
+    """Normalized instrument name used for lookups"""
+    return str(name).strip().lower()
+
+def format_quantity(value: float) -> str:
+    """Quantity as shown to users: 20 instead of 20.0"""
+    value = float(value)
+    return str(int(value)) if value.is_integer() else f"{value:g}"
+
+class Instrument:
+    """One inventory row. Columns are resolved once when the table is loaded"""
+
+    __slots__ = ('number', 'name', 'model', 'manufacturer', 'characteristics', 'image_url', 'slot', '_table')
+
+    def __init__(self, table: 'InstrumentTable', slot: int, number: int, name: str, model: str,
+                 manufacturer: str, characteristics: str, image_url: str):
+        self._table = table
+        self.slot = slot
+        self.number = number
+        self.name = name
+        self.model = model
+        self.manufacturer = manufacturer
+        self.characteristics = characteristics
+        self.image_url = image_url
+
+    @property
+    def quantity(self) -> float:
+        return float(self._table.quantities[self.slot])
+
+    def __repr__(self):
+        return f"Instrument(№{self.number}, {self.name!r}, quantity={format_quantity(self.quantity)})"
+
+class InstrumentTable:
+    """Instruments keyed by their stable number (№), kept in sheet order.
+
+    Hash indexes by number and by normalized name, the fuzzy and prefix
+    search indexes and the statistics aggregates are maintained on every
+    add and remove, so lookups and dashboards never scan the table. Quantities live in one
+    float64 array indexed by each record's slot, so totals and stock levels
+    can be computed without touching the records.
+
+    A loaded table (from_rows) starts without search indexes, so start-up
+    does not wait for them: build_indexes() makes them from the loaded
+    records in any thread, install_indexes() catches them up with later
+    changes. Until then searches fall back to a substring scan of the names,
+    so the indexes are never built on the event loop.
+
+    The table is not locked: the bot reads and changes it on the event loop
+    thread only (InventoryBot.apply_in_memory).
+    """
+
+    def __init__(self, capacity: int = 64):
+        self._by_number: Dict[int, Instrument] = {}  # insertion order == sheet order
+        self._by_name: Dict[str, Dict[int, None]] = {}  # name key -> numbers, in sheet order
+        self.search_index: Optional[SearchIndex] = SearchIndex()
+        self.prefix_index: Optional[PrefixIndex] = PrefixIndex()
+        self._index_source: List[Instrument] = []  # records build_indexes() starts from
+        self._unindexed: Set[int] = set()  # numbers added or removed since, while there are no indexes
+        self.aggregates: Optional[InventoryAggregates] = InventoryAggregates()
+        self.quantities = np.zeros(max(capacity, 1), dtype=np.float64)
+        self.alive = np.zeros(max(capacity, 1), dtype=bool)
+        self._free_slots: List[int] = []
+        self._next_slot = 0
+        self._ordered: Optional[List[Instrument]] = None
+
+    @classmethod
+    def from_rows(cls, rows: Iterable) -> 'InstrumentTable':
+        """Build the table from store rows (mappings with the store's field names)"""
+        rows = list(rows)
+        table = cls(capacity=len(rows) + 16)
+        table.aggregates = None  # computed in one vectorized pass below
+        table.search_index = table.prefix_index = None  # see build_indexes()
+        for row in rows:
+            table.add(row['number'], row['name'], row['model'], row['manufacturer'],
+                      row['characteristics'], row['quantity'], row['image_url'])
+        table.aggregates = InventoryAggregates.from_table(table)
+        table._index_source = table.ordered()
+        table._unindexed.clear()
+        return table
+
+    def __len__(self) -> int:
+        return len(self._by_number)
+
+    def __iter__(self) -> Iterator[Instrument]:
+        return iter(self._by_number.values())
+
+    def __contains__(self, number) -> bool:
+        return number in self._by_number
+
+    def get(self, number) -> Optional[Instrument]:
+        """Instrument by its stable number (accepts the string form from callback data)"""
+        try:
+            return self._by_number.get(int(number))
+        except (TypeError, ValueError):
+            return None
+
+    def find_by_name(self, name: str) -> Optional[Instrument]:
+        """First instrument (in sheet order) with this name, ignoring case and surrounding spaces"""
+        numbers = self._by_name.get(name_key(name))
+        if not numbers:
+            return None
+        return self._by_number[next(iter(numbers))]
+
+    def build_indexes(self) -> Tuple[SearchIndex, PrefixIndex]:
+        """Search indexes of the records the table was loaded with; safe to run in another thread"""
+        search_index, prefix_index = SearchIndex(), PrefixIndex()
+        for record in self._index_source:
+            fields = (record.name, record.model, record.manufacturer, record.characteristics)
+            search_index.add(record.number, *fields)
+            prefix_index.add(record.number, *fields)
+        return search_index, prefix_index
+
+    def install_indexes(self, search_index: SearchIndex, prefix_index: PrefixIndex):
+        """Start using indexes from build_indexes(), after replaying the changes made since the load"""
+        if self.search_index is not None:
+            return
+        for number in self._unindexed:
+            record = self._by_number.get(number)
+            if record is None:
+                search_index.remove(number)
+                prefix_index.remove(number)
+            else:
+                fields = (record.name, record.model, record.manufacturer, record.characteristics)
+                search_index.add(number, *fields)
+                prefix_index.add(number, *fields)
+        self._unindexed.clear()
+        self._index_source = []
+        self.search_index, self.prefix_index = search_index, prefix_index
+
+    @property
+    def indexed(self) -> bool:
+        """Whether the search indexes are installed (results before that come from _scan)"""
+        return self.search_index is not None
+
+    def _scan(self, query: str, limit: Optional[int] = None) -> List[Instrument]:
+        """Instruments whose name contains the query, in sheet order"""
+        needle = name_key(query)
+        found: List[Instrument] = []
+        if not needle:
+            return found
+        for key, numbers in self._by_name.items():
+            if needle in key:
+                found.extend(self._by_number[number] for number in numbers)
+                if limit is not None and len(found) >= limit:
+                    return found[:limit]
+        return found
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[Instrument]:
+        """Instruments matching a free-text query, most relevant first"""
+        if not self.indexed:
+            return self._scan(query, limit)
+        return [self._by_number[number] for number in self.search_index.search(query, limit)]
+
+    def lookup(self, query: str, limit: Optional[int] = None) -> List[Instrument]:
+        """As-you-type lookup: word prefixes first, fuzzy search when nothing starts with the query"""
+        if not self.indexed:
+            return self._scan(query, limit)
+        numbers = self.prefix_index.lookup(query, limit)
+        if not numbers:
+            numbers = self.search_index.search(query, limit)
+        return [self._by_number[number] for number in numbers]
+
+    def ordered(self) -> List[Instrument]:
+        """Instruments in sheet order (cached until the next add or remove)"""
+        if self._ordered is None:
+            self._ordered = list(self._by_number.values())
+        return self._ordered
+
+    def _allocate_slot(self) -> int:
+        if self._free_slots:
+            return self._free_slots.pop()
+        slot = self._next_slot
+        self._next_slot += 1
+        if slot >= len(self.quantities):
+            # Grow both arrays geometrically
+            capacity = len(self.quantities) * 2
+            self.quantities = np.resize(self.quantities, capacity)
+            self.alive = np.resize(self.alive, capacity)
+            self.alive[slot:] = False
+        return slot
+
+    def add(self, number: int, name: str, model: str = '', manufacturer: str = '',
+            characteristics: str = '', quantity: float = 0.0, image_url: str = '') -> Instrument:
+        number = int(number)
+        if number in self._by_number:
+            raise ValueError(f"Instrument №{number} already exists")
+        slot = self._allocate_slot()
+        record = Instrument(self, slot, number, name or '', model or '',
+                            sys.intern(manufacturer or ''), characteristics or '', image_url or '')
+        self.quantities[slot] = float(quantity or 0)
+        self.alive[slot] = True
+        if self.aggregates is not None:
+            self.aggregates.add(record.manufacturer, self.quantities[slot])
+        self._by_number[number] = record
+        self._by_name.setdefault(name_key(record.name), {})[number] = None
+        if self.search_index is None:
+            self._unindexed.add(number)
+        else:
+            self.search_index.add(number, record.name, record.model, record.manufacturer, record.characteristics)
+            self.prefix_index.add(number, record.name, record.model, record.manufacturer, record.characteristics)
+        self._ordered = None
+        return record
+
+    def remove(self, number: int) -> Optional[Instrument]:
+        record = self._by_number.pop(int(number), None)
+        if record is None:
+            return None
+        key = name_key(record.name)
+        numbers = self._by_name.get(key)
+        if numbers is not None:
+            numbers.pop(record.number, None)
+            if not numbers:
+                del self._by_name[key]
+        if self.search_index is None:
+            self._unindexed.add(record.number)
+        else:
+            self.search_index.remove(record.number)
+            self.prefix_index.remove(record.number)
+        if self.aggregates is not None:
+            self.aggregates.remove(record.manufacturer, self.quantities[record.slot])
+        self.quantities[record.slot] = 0.0
+        self.alive[record.slot] = False
+        self._free_slots.append(record.slot)
+        self._ordered = None
+        return record
+
+    def set_quantity(self, number: int, quantity: float) -> bool:
+        record = self._by_number.get(int(number))
+        if record is None:
+            return False
+        if self.aggregates is not None:
+            self.aggregates.change_quantity(float(self.quantities[record.slot]), float(quantity))
+        self.quantities[record.slot] = float(quantity)
+        return True
+
+    def live_quantities(self) -> np.ndarray:
+        """Quantities of existing instruments only"""
+        return self.quantities[:self._next_slot][self.alive[:self._next_slot]]
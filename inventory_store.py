@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+SQLite inventory store
+Локальное хранилище инвентаря и истории; Excel файлы формируются из него по запросу
+"""
+
+import json
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+import pandas as pd
+from inventory_model import name_key
+
+logger = logging.getLogger(__name__)
+
+# Workbook column -> table column for the known inventory fields
+INVENTORY_FIELDS = {
+    '№': 'number',
+    'Наименование': 'name',
+    'Модель': 'model',
+    'Компания производителя': 'manufacturer',
+    'Характеристика ': 'characteristics',
+    'Количество': 'quantity',
+    'ImageURL': 'image_url',
+}
+TEXT_FIELDS = ('name', 'model', 'manufacturer', 'characteristics', 'image_url')
+
+HISTORY_FIELDS = ('number', 'name', 'action', 'instrument_name', 'change', 'time')
+
+# Meta key of the instrument number counter; numbers of deleted instruments are never handed out again
+NEXT_NUMBER_KEY = 'next_instrument_number'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instruments (
+    number INTEGER PRIMARY KEY,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL DEFAULT '',
+    name_key TEXT NOT NULL DEFAULT '',
+    model TEXT NOT NULL DEFAULT '',
+    manufacturer TEXT NOT NULL DEFAULT '',
+    characteristics TEXT NOT NULL DEFAULT '',
+    quantity REAL NOT NULL DEFAULT 0,
+    image_url TEXT NOT NULL DEFAULT '',
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS idx_instruments_position ON instruments(position);
+CREATE INDEX IF NOT EXISTS idx_instruments_name_key ON instruments(name_key);
+CREATE INDEX IF NOT EXISTS idx_instruments_manufacturer ON instruments(manufacturer);
+
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    number TEXT NOT NULL DEFAULT '',
+    name TEXT NOT NULL DEFAULT '',
+    action TEXT NOT NULL DEFAULT '',
+    instrument_name TEXT NOT NULL DEFAULT '',
+    change TEXT NOT NULL DEFAULT '',
+    time TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_history_time ON history(time);
+CREATE INDEX IF NOT EXISTS idx_history_instrument_name ON history(instrument_name);
+
+-- Inventory rows as last written to the Google Sheet, for diff sync
+CREATE TABLE IF NOT EXISTS sheet_rows (
+    position INTEGER PRIMARY KEY,
+    number INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    cells TEXT NOT NULL
+);
+
+-- Instrument -> image in the content-addressed image store
+CREATE TABLE IF NOT EXISTS instrument_images (
+    number INTEGER PRIMARY KEY,
+    digest TEXT NOT NULL,
+    format TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_instrument_images_digest ON instrument_images(digest);
+
+-- file_id values Telegram returned for uploaded photos and documents
+CREATE TABLE IF NOT EXISTS telegram_files (
+    key TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+def _text(value) -> str:
+    """Cell value as text, with NaN/0 placeholders from pandas mapped to ''"""
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return ''
+    if isinstance(value, (int, float)) and value == 0:
+        return ''
+    return str(value)
+
+def _number(value, default: float = 0.0) -> float:
+    try:
+        if value is None or pd.isna(value) or value == '':
+            return default
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+def _quantity_cell(value: float):
+    """Whole quantities go back to Excel as integers"""
+    return int(value) if float(value).is_integer() else value
+
+def _sheet_cell(value):
+    """Cell value as a JSON-friendly type for the Sheets API"""
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return ''
+    if hasattr(value, 'item'):  # numpy scalars
+        return value.item()
+    return value
+
+class InventoryStore:
+    """Inventory and history tables in an embedded SQLite database (WAL mode)"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()  # one connection per thread
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        with conn:
+            # Stores created before the counter existed: start it above every number in use
+            conn.execute('BEGIN IMMEDIATE')
+            used = conn.execute(
+                'SELECT MAX((SELECT COALESCE(MAX(number), 0) FROM instruments), '
+                '(SELECT COALESCE(MAX(number), 0) FROM instrument_images))').fetchone()[0]
+            self._numbers_used_up_to(conn, used)
+        logger.info(f"Inventory store ready: {db_path}")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = conn
+        return conn
+
+    # --- meta ---
+
+    def get_meta(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        row = self._connection().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row else default
+
+    def set_meta(self, key: str, value: str):
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    # --- inventory ---
+
+    def instrument_count(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM instruments').fetchone()[0]
+
+    def inventory_columns(self) -> List[str]:
+        """Workbook column order of the last import"""
+        columns = self.get_meta('inventory_columns')
+        return json.loads(columns) if columns else list(INVENTORY_FIELDS)
+
+    def replace_inventory(self, df: pd.DataFrame):
+        """Replace all instruments with the rows of an inventory workbook, in one transaction"""
+        columns = [str(col) for col in df.columns]
+        for col in INVENTORY_FIELDS:
+            if col not in columns:
+                columns.append(col)
+
+        rows = []
+        used_numbers = set()
+        next_number = int(max([_number(v) for v in df['№']] or [0])) + 1 if '№' in df.columns else 1
+        next_number = max(next_number, int(self.get_meta(NEXT_NUMBER_KEY, '1')))  # no deleted number comes back
+        for position, record in enumerate(df.to_dict('records')):
+            number = int(_number(record.get('№'), 0))
+            if number <= 0 or number in used_numbers:
+                # Every instrument needs a unique stable number
+                number = next_number
+                next_number += 1
+            used_numbers.add(number)
+
+            values = {field: _text(record.get(col)) for col, field in INVENTORY_FIELDS.items() if field in TEXT_FIELDS}
+            extra = {col: record[col] for col in record if col not in INVENTORY_FIELDS and not pd.isna(record[col])}
+            rows.append((
+                number, position, values['name'], name_key(values['name']), values['model'],
+                values['manufacturer'], values['characteristics'], _number(record.get('Количество')),
+                values['image_url'], json.dumps(extra, ensure_ascii=False, default=str)
+            ))
+
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM instruments')
+            conn.executemany(
+                'INSERT INTO instruments (number, position, name, name_key, model, manufacturer, '
+                'characteristics, quantity, image_url, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                         ('inventory_columns', json.dumps(columns, ensure_ascii=False)))
+            self._numbers_used_up_to(conn, max(used_numbers, default=0))
+        logger.info(f"Imported {len(rows)} instruments into the store")
+
+    def instrument_rows(self) -> List[sqlite3.Row]:
+        """Known fields of all instruments, in sheet order"""
+        return self._connection().execute(
+            'SELECT number, name, model, manufacturer, characteristics, quantity, image_url '
+            'FROM instruments ORDER BY position').fetchall()
+
+    def _inventory_records(self) -> List[Dict]:
+        """All instruments as workbook records (column -> value), in sheet order"""
+        records = []
+        for row in self._connection().execute('SELECT * FROM instruments ORDER BY position'):
+            record = json.loads(row['extra'])
+            for col, field in INVENTORY_FIELDS.items():
+                record[col] = row[field]
+            record['Количество'] = _quantity_cell(row['quantity'])
+            records.append(record)
+        return records
+
+    def inventory_frame(self) -> pd.DataFrame:
+        """All instruments as a DataFrame with the workbook's columns, in sheet order"""
+        return pd.DataFrame(self._inventory_records(), columns=self.inventory_columns())
+
+    def inventory_cells(self) -> Tuple[List[str], List[Tuple[int, list]]]:
+        """Workbook columns and (number, cell values) per instrument, in sheet order"""
+        columns = self.inventory_columns()
+        rows = [
+            (record['№'], [_sheet_cell(record.get(col)) for col in columns])
+            for record in self._inventory_records()
+        ]
+        return columns, rows
+
+    def set_quantity(self, number: int, quantity: float) -> bool:
+        """Update one instrument's quantity; returns False if the number does not exist"""
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute('UPDATE instruments SET quantity = ? WHERE number = ?', (float(quantity), int(number)))
+        return cursor.rowcount == 1
+
+    def _next_number(self, conn: sqlite3.Connection) -> int:
+        row = conn.execute('SELECT value FROM meta WHERE key = ?', (NEXT_NUMBER_KEY,)).fetchone()
+        return int(row['value']) if row else 1
+
+    def _numbers_used_up_to(self, conn: sqlite3.Connection, number: int):
+        """Move the counter past `number` (inside a write transaction); it never moves back"""
+        if self._next_number(conn) <= number:
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (NEXT_NUMBER_KEY, str(number + 1)))
+
+    def _allocate_number(self, conn: sqlite3.Connection) -> int:
+        """Take the next instrument number from the counter (inside a write transaction)"""
+        number = self._next_number(conn)
+        self._numbers_used_up_to(conn, number)
+        return number
+
+    def allocate_number(self) -> int:
+        """Reserve a number for an instrument that is still being created (its image is stored first)"""
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            return self._allocate_number(conn)
+
+    def insert_instrument(self, row: Dict) -> int:
+        """Insert a new instrument after the last one and return its number (reserved, or taken from the counter)"""
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            max_position = conn.execute('SELECT COALESCE(MAX(position), -1) FROM instruments').fetchone()[0]
+            number = int(_number(row.get('№'), 0)) or self._allocate_number(conn)
+            self._numbers_used_up_to(conn, number)
+            name = _text(row.get('Наименование'))
+            extra = {col: value for col, value in row.items() if col not in INVENTORY_FIELDS}
+            conn.execute(
+                'INSERT INTO instruments (number, position, name, name_key, model, manufacturer, '
+                'characteristics, quantity, image_url, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (number, max_position + 1, name, name_key(name), _text(row.get('Модель')),
+                 _text(row.get('Компания производителя')), _text(row.get('Характеристика ')),
+                 _number(row.get('Количество')), _text(row.get('ImageURL')),
+                 json.dumps(extra, ensure_ascii=False, default=str))
+            )
+        return number
+
+    def delete_instrument(self, number: int) -> bool:
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute('DELETE FROM instruments WHERE number = ?', (int(number),))
+            conn.execute('DELETE FROM instrument_images WHERE number = ?', (int(number),))
+        return cursor.rowcount == 1
+
+    # --- images ---
+
+    def image_refs(self) -> Dict[int, Tuple[str, str]]:
+        """Instrument number -> (digest, format) of its stored image"""
+        return {row['number']: (row['digest'], row['format'])
+                for row in self._connection().execute('SELECT number, digest, format FROM instrument_images')}
+
+    def set_image_ref(self, number: int, digest: str, image_format: str):
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO instrument_images (number, digest, format) VALUES (?, ?, ?)',
+                         (int(number), digest, image_format))
+
+    # --- sheet snapshot ---
+
+    def sheet_snapshot(self) -> Tuple[Optional[List[str]], List[Tuple[int, str, list]]]:
+        """Columns and (number, hash, cells) rows last written to the Google Sheet; columns is None if never synced"""
+        columns = self.get_meta('sheet_columns')
+        rows = [
+            (row['number'], row['hash'], json.loads(row['cells']))
+            for row in self._connection().execute('SELECT number, hash, cells FROM sheet_rows ORDER BY position')
+        ]
+        return (json.loads(columns) if columns else None), rows
+
+    def update_sheet_snapshot(self, columns: List[str], changed: List[Tuple[int, int, str, list]], length: int):
+        """Record (position, number, hash, cells) rows written to the sheet and drop rows past `length`"""
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO sheet_rows (position, number, hash, cells) VALUES (?, ?, ?, ?)',
+                [(position, int(number), row_hash, json.dumps(cells, ensure_ascii=False, default=str))
+                 for position, number, row_hash, cells in changed]
+            )
+            conn.execute('DELETE FROM sheet_rows WHERE position >= ?', (int(length),))
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                         ('sheet_columns', json.dumps(columns, ensure_ascii=False)))
+
+    # --- telegram file ids ---
+
+    def telegram_file_ids(self) -> Dict[str, str]:
+        return {row['key']: row['file_id'] for row in self._connection().execute('SELECT key, file_id FROM telegram_files')}
+
+    def put_telegram_file_id(self, key: str, file_id: str):
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO telegram_files (key, file_id) VALUES (?, ?)', (key, file_id))
+
+    def delete_telegram_file_id(self, key: str):
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM telegram_files WHERE key = ?', (key,))
+
+    # --- history ---
+
+    def history_count(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM history').fetchone()[0]
+
+    def replace_history(self, entries: List[Dict]):
+        """Replace the history table with entries from the history workbook"""
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM history')
+            conn.executemany(
+                'INSERT INTO history (number, name, action, instrument_name, change, time) VALUES (?, ?, ?, ?, ?, ?)',
+                [tuple(str(entry.get(field, '')) for field in HISTORY_FIELDS) for entry in entries]
+            )
+        logger.info(f"Imported {len(entries)} history entries into the store")
+
+    def append_history(self, entry: Dict) -> int:
+        """Append one entry to the history journal and return its row id"""
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                'INSERT INTO history (number, name, action, instrument_name, change, time) VALUES (?, ?, ?, ?, ?, ?)',
+                tuple(str(entry.get(field, '')) for field in HISTORY_FIELDS)
+            )
+        return cursor.lastrowid
+
+    def last_history_id(self) -> int:
+        """Row id of the newest history entry (0 when empty); changes whenever the journal does"""
+        return self._connection().execute('SELECT COALESCE(MAX(id), 0) FROM history').fetchone()[0]
+
+    def history_since(self, after_id: int) -> List[sqlite3.Row]:
+        """Entries (with their row id) appended after the given row id, oldest first"""
+        return self._connection().execute(
+            'SELECT id, number, name, action, instrument_name, change, time FROM history WHERE id > ? ORDER BY id',
+            (int(after_id),)).fetchall()
+
+    def recent_history(self, limit: int) -> List[Dict]:
+        """The newest `limit` entries, oldest first"""
+        rows = self._connection().execute(
+            'SELECT number, name, action, instrument_name, change, time FROM history ORDER BY id DESC LIMIT ?',
+            (int(limit),)).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+    def history_entries(self) -> List[Dict]:
+        rows = self._connection().execute(
+            'SELECT number, name, action, instrument_name, change, time FROM history ORDER BY id')
+        return [dict(row) for row in rows]
+
+    def history_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.history_entries(), columns=list(HISTORY_FIELDS))
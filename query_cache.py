@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Versioned result cache
+Кэш готовых ответов, действительных для одной версии данных инвентаря
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+class VersionedCache:
+    """Small LRU of computed results, each valid for one data version.
+
+    An entry is returned only while the version it was computed for is
+    still current and its TTL has not passed; any inventory change bumps
+    the version, so stale entries are never served and simply age out.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()  # key -> (version, expires, value)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, version: int) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry_version, expires, value = entry
+            if entry_version != version or expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, version: int, value: Any):
+        with self._lock:
+            self._entries[key] = (version, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
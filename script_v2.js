@@ -5,6 +5,20 @@ const SHEET_ID = '1McGe_kQVIonC4soSTi1nPjH4WlGI0vlS';
 const SHEET_GID = '1496744611'; // gid parameter
 const SHEET_NAME = 'Sheet1'; // or the actual sheet name
 
+// Card images are requested from the image server already resized (?w=),
+// the server picks WebP/JPEG from the Accept header
+const CARD_IMAGE_WIDTH = 200;
+const RESIZABLE_IMAGE = /(^|\/)image\d+\.(png|jpe?g)$/i;
+
+function cardImageSrc(src, width) {
+    return RESIZABLE_IMAGE.test(src) ? `${src}?w=${width}` : src;
+}
+
+function cardImageSrcset(src) {
+    if (!RESIZABLE_IMAGE.test(src)) return '';
+    return `${cardImageSrc(src, CARD_IMAGE_WIDTH)} 1x, ${cardImageSrc(src, CARD_IMAGE_WIDTH * 2)} 2x`;
+}
+
 let inventoryData = [];
 let currentPage = 1;
 const itemsPerPage = 12;
@@ -83,12 +97,13 @@ function displayInventory() {
     
     currentItems.forEach(item => {
         const imageSrc = item.imageURL ? item.imageURL : `image${item.id}.png`;
+        const imageSrcset = cardImageSrcset(imageSrc);
         
         html += `
             <div class="card">
                 <div class="card-image">
                     ${item.imageURL ? 
-                        `<img src="${imageSrc}" alt="${item.name}" onerror="this.onerror=null; this.src='https://via.placeholder.com/200x200?text=No+Image';" />` :
+                        `<img src="${cardImageSrc(imageSrc, CARD_IMAGE_WIDTH)}" ${imageSrcset ? `srcset="${imageSrcset}"` : ''} alt="${item.name}" loading="lazy" onerror="this.onerror=null; this.removeAttribute('srcset'); this.src='https://via.placeholder.com/200x200?text=No+Image';" />` :
                         `<div class="placeholder-image">
                             <span class="placeholder-text">🖼️</span>
                         </div>`
@@ -241,12 +256,13 @@ function searchInventory(query) {
     let html = '';
     filtered.forEach(item => {
         const imageSrc = item.imageURL ? item.imageURL : `image${item.id}.png`;
+        const imageSrcset = cardImageSrcset(imageSrc);
         
         html += `
             <div class="card">
                 <div class="card-image">
                     ${item.imageURL ? 
-                        `<img src="${imageSrc}" alt="${item.name}" onerror="this.onerror=null; this.src='https://via.placeholder.com/200x200?text=No+Image';" />` :
+                        `<img src="${cardImageSrc(imageSrc, CARD_IMAGE_WIDTH)}" ${imageSrcset ? `srcset="${imageSrcset}"` : ''} alt="${item.name}" loading="lazy" onerror="this.onerror=null; this.removeAttribute('srcset'); this.src='https://via.placeholder.com/200x200?text=No+Image';" />` :
                         `<div class="placeholder-image">
                             <span class="placeholder-text">🖼️</span>
                         </div>`
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Instrument search index
+Нечёткий поиск инструментов: триграммный инвертированный индекс с ранжированием по релевантности
+"""
+
+from bisect import bisect_left, insort
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+from search_normalize import normalize_text, tokens
+
+# One typo costs up to three trigrams; words shorter than this must match exactly
+TYPO_MIN_WORD = 5
+# Removed records are only flagged; the postings are rebuilt once this share of them is dead
+COMPACT_SHARE = 0.25
+
+def document_grams(text: str) -> set:
+    """Trigrams of every word padded on both sides, plus a two-letter start gram for one-letter queries"""
+    grams = set()
+    for word in text.split():
+        padded = f" {word} "
+        grams.add(padded[:2])
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def query_grams(text: str) -> set:
+    """Trigrams of a query; only the last word is left open at the end, so it alone matches as a prefix"""
+    grams = set()
+    words = text.split()
+    for position, word in enumerate(words):
+        padded = f" {word}" if position == len(words) - 1 else f" {word} "
+        if len(padded) < 3:
+            grams.add(padded)
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class SearchIndex:
+    """Trigram index over name, model, manufacturer and characteristics.
+
+    Records and queries go through the same normalization (search_normalize),
+    and each record's normalized text is computed once when it is added.
+
+    Every record gets a document id in insertion (sheet) order. Postings are
+    kept as lists for cheap appends and frozen into NumPy arrays on first
+    use, so a query is one bincount over the postings of its trigrams. The
+    best candidates are then re-ranked: trigrams found in the name count
+    double, and records containing the whole query as a substring are
+    boosted, so the best matches come first.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, List[int]] = {}  # trigram -> doc ids
+        self._arrays: Dict[str, np.ndarray] = {}  # frozen postings
+        self._numbers: List[int] = []  # doc id -> instrument number
+        self._texts: List[Tuple[str, str]] = []  # doc id -> (normalized name, normalized record)
+        self._docs: Dict[int, int] = {}  # instrument number -> live doc id
+        self._alive = np.zeros(64, dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def add(self, number: int, name: str, model: str = '', manufacturer: str = '', characteristics: str = ''):
+        number = int(number)
+        if number in self._docs:
+            self.remove(number)
+        name_text = normalize_text(name)
+        record_text = ' '.join(filter(None, (name_text, normalize_text(model), normalize_text(manufacturer),
+                                             normalize_text(characteristics))))
+        self._add_doc(number, name_text, record_text)
+
+    def _add_doc(self, number: int, name_text: str, record_text: str):
+        doc = len(self._numbers)
+        self._numbers.append(number)
+        self._texts.append((name_text, record_text))
+        self._docs[number] = doc
+        if doc >= len(self._alive):
+            self._alive = np.resize(self._alive, len(self._alive) * 2)
+        self._alive[doc] = True
+        for gram in document_grams(record_text):
+            self._postings.setdefault(gram, []).append(doc)
+            self._arrays.pop(gram, None)
+
+    def remove(self, number: int):
+        doc = self._docs.pop(int(number), None)
+        if doc is None:
+            return
+        self._alive[doc] = False
+        if len(self._numbers) - len(self._docs) > COMPACT_SHARE * len(self._numbers) and len(self._numbers) > 64:
+            self._compact()
+
+    def _compact(self):
+        """Rebuild the postings from live records, keeping their order"""
+        live = [(self._numbers[doc], *self._texts[doc]) for doc in range(len(self._numbers)) if self._alive[doc]]
+        self.__init__()
+        for number, name_text, record_text in live:
+            self._add_doc(number, name_text, record_text)
+
+    def _array(self, gram: str) -> Optional[np.ndarray]:
+        array = self._arrays.get(gram)
+        if array is None:
+            postings = self._postings.get(gram)
+            if postings is None:
+                return None
+            array = self._arrays[gram] = np.array(postings, dtype=np.int32)
+        return array
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[int]:
+        """Instrument numbers matching the query, best first (typos are tolerated)"""
+        text = normalize_text(query)
+        grams = query_grams(text)
+        if not grams or not self._docs:
+            return []
+        arrays = [array for array in map(self._array, grams) if array is not None]
+        if not arrays:
+            return []
+        counts = np.bincount(np.concatenate(arrays), minlength=len(self._numbers))
+        typos = sum(1 for word in text.split() if len(word) >= TYPO_MIN_WORD)
+        needed = max(1, len(grams) - 3 * typos, len(grams) // 3)
+        candidates = np.flatnonzero(counts >= needed)
+        candidates = candidates[self._alive[candidates]]
+        if not len(candidates):
+            return []
+        scores = counts[candidates]
+
+        # Pre-select by trigram score, then refine the short list with name and substring boosts
+        shortlist = len(candidates) if limit is None else min(len(candidates), max(limit * 4, 32))
+        if shortlist < len(candidates):
+            top = np.argpartition(-scores, shortlist - 1)[:shortlist]
+            candidates, scores = candidates[top], scores[top]
+        ranked = []
+        for doc, score in zip(candidates.tolist(), scores.tolist()):
+            name_text, record_text = self._texts[doc]
+            # Same as intersecting with document_grams(name_text): query grams never span two words
+            padded_name = f" {name_text.replace(' ', '  ')} "
+            score += sum(1 for gram in grams if gram in padded_name)
+            if text in name_text:
+                score += len(grams) * (2 if name_text.startswith(text) else 1)
+            elif text in record_text:
+                score += len(grams) // 2
+            ranked.append((-score, doc))
+        ranked.sort()
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [self._numbers[doc] for _, doc in ranked]
+
+class PrefixIndex:
+    """Sorted word keys -> instrument numbers, for as-you-type lookups.
+
+    Every normalized word of a record is a key; the last query word selects
+    the contiguous range of keys starting with it (a flattened trie), the
+    others must equal a key, and the numbers found for all query words are
+    intersected. Records whose name
+    holds the matches come before those matching only other fields.
+    """
+
+    def __init__(self):
+        self._keys: List[str] = []  # sorted
+        self._numbers: Dict[str, Dict[int, bool]] = {}  # key -> {number: key is in the name}
+        self._record_keys: Dict[int, List[str]] = {}  # number -> its keys, for remove()
+
+    def __len__(self) -> int:
+        return len(self._record_keys)
+
+    def add(self, number: int, name: str, model: str = '', manufacturer: str = '', characteristics: str = ''):
+        number = int(number)
+        if number in self._record_keys:
+            self.remove(number)
+        name_keys = set(tokens(name))
+        keys = name_keys.union(tokens(model), tokens(manufacturer), tokens(characteristics))
+        for key in keys:
+            numbers = self._numbers.get(key)
+            if numbers is None:
+                numbers = self._numbers[key] = {}
+                insort(self._keys, key)
+            numbers[number] = key in name_keys
+        self._record_keys[number] = list(keys)
+
+    def remove(self, number: int):
+        for key in self._record_keys.pop(int(number), ()):
+            numbers = self._numbers[key]
+            numbers.pop(int(number), None)
+            if not numbers:
+                del self._numbers[key]
+                del self._keys[bisect_left(self._keys, key)]
+
+    def _prefix_matches(self, prefix: str) -> Dict[int, bool]:
+        """number -> whether a name key starts with the prefix"""
+        matches: Dict[int, bool] = {}
+        position = bisect_left(self._keys, prefix)
+        while position < len(self._keys) and self._keys[position].startswith(prefix):
+            for number, in_name in self._numbers[self._keys[position]].items():
+                matches[number] = matches.get(number, False) or in_name
+            position += 1
+        return matches
+
+    def lookup(self, query: str, limit: Optional[int] = None) -> List[int]:
+        """Numbers of records having every query word, the last one possibly unfinished"""
+        words = tokens(query)
+        if not words:
+            return []
+        complete = set(words[:-1])
+        per_word = [self._numbers.get(word, {}) for word in complete]
+        if words[-1] not in complete:
+            per_word.append(self._prefix_matches(words[-1]))
+        # Fewest candidates first keeps the intersection small
+        per_word.sort(key=len)
+        found = per_word[0]
+        scores = {number: int(in_name) for number, in_name in found.items()}
+        for matches in per_word[1:]:
+            scores = {number: score + int(matches[number]) for number, score in scores.items() if number in matches}
+        ranked = sorted(scores, key=lambda number: (-scores[number], number))
+        return ranked if limit is None else ranked[:limit]
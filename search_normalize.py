@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Search text normalization
+Приведение названий к единому виду для поиска: транслитерация, ё/е, основы слов, числа и единицы
+"""
+
+import re
+from functools import lru_cache
+from typing import List
+
+# Numbers (with a decimal comma or point) and letter runs; "10мм" is two tokens
+TOKEN = re.compile(r'\d+(?:[.,]\d+)?|[^\W\d_]+')
+CYRILLIC = re.compile(r'[а-яё]')
+
+TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh',
+    'з': 'z', 'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o',
+    'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts',
+    'ч': 'ch', 'ш': 'sh', 'щ': 'sh', 'ъ': '', 'ы': 'i', 'ь': '', 'э': 'e', 'ю': 'yu',
+    'я': 'ya',
+})
+
+# Spelling differences between English words and transliterated Russian ones:
+# "Bosch" and "Бош" both become "bosh", "controller" and "контроллер" "kontroler"
+LATIN_FOLDS = (
+    (re.compile(r'sch'), 'sh'),
+    (re.compile(r'tch'), 'ch'),
+    (re.compile(r'ph'), 'f'),
+    (re.compile(r'th'), 't'),
+    (re.compile(r'ck'), 'k'),
+    (re.compile(r'qu'), 'kv'),
+    (re.compile(r'q'), 'k'),
+    (re.compile(r'w'), 'v'),
+    (re.compile(r'x'), 'ks'),
+    (re.compile(r'c(?!h)'), 'k'),
+    (re.compile(r'y'), 'i'),
+    (re.compile(r'(.)\1+'), r'\1'),
+)
+# Short words are mostly model codes (SSR, PG): they are only transliterated
+FOLD_MIN_LENGTH = 4
+
+# Noun and adjective endings, longest first; the stem keeps at least STEM_MIN_LENGTH letters
+RUSSIAN_ENDINGS = sorted((
+    'иями', 'ями', 'ами', 'иях', 'ях', 'ах', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими',
+    'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ый', 'ий', 'ой', 'ей', 'ом', 'ем', 'ам', 'ям',
+    'ов', 'ев', 'ия', 'ья', 'ию', 'ью', 'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+), key=len, reverse=True)
+STEM_MIN_LENGTH = 3
+
+# A unit right after a number, in either script -> one canonical symbol
+UNITS = {
+    'мм': 'mm', 'mm': 'mm', 'см': 'cm', 'cm': 'cm', 'м': 'm', 'm': 'm', 'мкм': 'um', 'um': 'um',
+    'в': 'v', 'v': 'v', 'вт': 'w', 'w': 'w', 'квт': 'kw', 'kw': 'kw', 'а': 'a', 'a': 'a',
+    'ма': 'ma', 'ma': 'ma', 'с': 'c', 'c': 'c', 'кг': 'kg', 'kg': 'kg', 'г': 'g', 'g': 'g',
+    'гц': 'hz', 'hz': 'hz', 'л': 'l', 'l': 'l', 'шт': 'pcs', 'pcs': 'pcs',
+}
+
+# English names of catalog items -> the Russian word they are stored under
+SYNONYMS = {
+    'thermocouple': 'термопара',
+    'relay': 'реле',
+    'timer': 'таймер',
+    'button': 'кнопка',
+    'switch': 'выключатель',
+    'fan': 'вентилятор',
+    'sieve': 'сито',
+    'sensor': 'датчик',
+    'lamp': 'лампа',
+    'socket': 'розетка',
+    'clamp': 'зажим',
+}
+SYNONYM_KEYS = {}  # filled from SYNONYMS below, once word_key exists
+
+def fold_latin(word: str) -> str:
+    for pattern, replacement in LATIN_FOLDS:
+        word = pattern.sub(replacement, word)
+    return word
+
+# The endings as they look after transliteration and folding ("ая" -> "aia"), so that
+# a Russian word typed in Latin letters ("sito") gets the same stem as in Cyrillic
+LATIN_ENDINGS = sorted({fold_latin(ending.translate(TRANSLIT)) for ending in RUSSIAN_ENDINGS} - {''},
+                       key=len, reverse=True)
+
+def stem_russian(word: str) -> str:
+    """Stem of a transliterated and folded word"""
+    for ending in LATIN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= STEM_MIN_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+def stem_english(word: str) -> str:
+    if len(word) > 4 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+@lru_cache(maxsize=65536)
+def word_key(word: str) -> str:
+    """Script-independent key of one lower-cased word: stemmed after transliteration"""
+    if CYRILLIC.search(word):
+        key = word.replace('ё', 'е').translate(TRANSLIT)
+    else:
+        key = stem_english(word)
+    if len(key) >= FOLD_MIN_LENGTH:
+        key = stem_russian(fold_latin(key))
+    return SYNONYM_KEYS.get(key, key)
+
+def number_key(token: str) -> str:
+    """Decimal point and no trailing zeros: 1,5 -> 1.5, 10.0 -> 10"""
+    number = token.replace(',', '.')
+    if '.' in number:
+        number = number.rstrip('0').rstrip('.') or '0'
+    return number
+
+def tokens(text) -> List[str]:
+    """Search keys of a text, in order"""
+    keys = []
+    after_number = False
+    for token in TOKEN.findall(str(text or '').lower()):
+        if token[0].isdigit():
+            keys.append(number_key(token))
+            after_number = True
+            continue
+        if after_number and token in UNITS:
+            keys.append(UNITS[token])
+        else:
+            keys.append(word_key(token))
+        after_number = False
+    return keys
+
+def normalize_text(text) -> str:
+    """Normalized form used both for indexing records and for queries"""
+    return ' '.join(tokens(text))
+
+SYNONYM_KEYS.update({word_key(english): word_key(russian) for english, russian in SYNONYMS.items()})
+word_key.cache_clear()
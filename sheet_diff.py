@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Inventory sheet diff
+Вычисление изменённых ячеек между последней синхронизацией и текущим инвентарём
+"""
+
+import json
+import hashlib
+from typing import List, Optional, Sequence, Tuple
+from openpyxl.utils import get_column_letter
+
+# (number, cells) for the current inventory, (number, hash, cells) for the synced snapshot
+Row = Tuple[int, list]
+SyncedRow = Tuple[int, str, list]
+
+def row_hash(cells: Sequence) -> str:
+    """Short stable hash of one row's cell values"""
+    payload = json.dumps(list(cells), ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+def _range(row: int, first_col: int, last_col: int) -> str:
+    """A1 range within one sheet row (1-based row and column numbers); no sheet name means the first sheet"""
+    return f"{get_column_letter(first_col)}{row}:{get_column_letter(last_col)}{row}"
+
+def _changed_runs(old: Sequence, new: Sequence) -> List[Tuple[int, int]]:
+    """Runs of consecutive differing cells as (start, end) column indexes, end exclusive"""
+    width = max(len(old), len(new))
+    runs = []
+    start = None
+    for col in range(width):
+        old_value = old[col] if col < len(old) else ''
+        new_value = new[col] if col < len(new) else ''
+        if old_value != new_value:
+            if start is None:
+                start = col
+        elif start is not None:
+            runs.append((start, col))
+            start = None
+    if start is not None:
+        runs.append((start, width))
+    return runs
+
+def diff_rows(columns: List[str], rows: List[Row], synced_columns: Optional[List[str]],
+              synced_rows: List[SyncedRow]) -> List[dict]:
+    """ValueRange updates that turn the synced sheet into the current inventory.
+
+    Row i of the inventory is sheet row i + 2 (row 1 is the header). Rows are
+    matched by position and identified by their №: an unchanged hash is
+    skipped, the same № gets only its changed cells, a different № gets the
+    whole row, and rows past the end of the inventory are blanked. Without a
+    baseline (synced_columns is None: never synced) or with other columns,
+    the header and every row are rewritten.
+    """
+    data = []
+    full_rewrite = synced_columns is None or columns != synced_columns
+    width = max(len(columns), len(synced_columns or ()))
+    if full_rewrite:
+        header = list(columns) + [''] * (width - len(columns))
+        data.append({'range': _range(1, 1, width), 'values': [header]})
+
+    for position, (number, cells) in enumerate(rows):
+        sheet_row = position + 2
+        synced = synced_rows[position] if position < len(synced_rows) else None
+        if synced and not full_rewrite:
+            synced_number, synced_hash, synced_cells = synced
+            if synced_hash == row_hash(cells):
+                continue
+            if synced_number == number:
+                for start, end in _changed_runs(synced_cells, cells):
+                    values = [cells[col] if col < len(cells) else '' for col in range(start, end)]
+                    data.append({'range': _range(sheet_row, start + 1, end), 'values': [values]})
+                continue
+        values = list(cells) + [''] * (width - len(cells))
+        data.append({'range': _range(sheet_row, 1, width), 'values': [values]})
+
+    if len(synced_rows) > len(rows):
+        # Deleted rows at the end: clear what is left of the old data
+        first, last = len(rows) + 2, len(synced_rows) + 1
+        data.append({
+            'range': f"A{first}:{get_column_letter(width)}{last}",
+            'values': [[''] * width for _ in range(last - first + 1)],
+        })
+    return data
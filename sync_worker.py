@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Debounced write-behind sync worker
+Фоновая синхронизация с Google Drive: серия изменений превращается в одну загрузку
+"""
+
+import logging
+import threading
+import time
+from typing import Callable, Dict, Set
+
+logger = logging.getLogger(__name__)
+
+class SyncWorker:
+    """Background thread that coalesces dirty sync targets into one flush per debounce window"""
+
+    def __init__(self, flush_callbacks: Dict[str, Callable[[], bool]],
+                 debounce_seconds: float = 15.0, max_delay_seconds: float = 60.0):
+        """
+        flush_callbacks maps a target name ('inventory', 'history') to a function
+        that uploads it and returns True on success.
+
+        A target is flushed once no new changes arrived for debounce_seconds,
+        but never later than max_delay_seconds after it first became dirty.
+        """
+        self.flush_callbacks = flush_callbacks
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max(max_delay_seconds, debounce_seconds)
+        self._dirty: Dict[str, float] = {}  # target -> time it first became dirty
+        self._uploading: Set[str] = set()  # targets taken by a flush that has not finished them yet
+        self._changes: Dict[str, int] = {target: 0 for target in flush_callbacks}  # mark_dirty calls per target
+        self._last_change = 0.0
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()  # one flush at a time (worker, force_sync, shutdown)
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """Start the background thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='sync-worker', daemon=True)
+        self._thread.start()
+        logger.info(f"Sync worker started (debounce {self.debounce_seconds}s, max delay {self.max_delay_seconds}s)")
+
+    def mark_dirty(self, target: str):
+        """Record that a target changed; the upload happens later in the background"""
+        if target not in self.flush_callbacks:
+            logger.error(f"Unknown sync target: {target}")
+            return
+        with self._condition:
+            now = time.monotonic()
+            self._dirty.setdefault(target, now)
+            self._changes[target] += 1
+            self._last_change = now
+            self._condition.notify()
+
+    def changes(self, target: str) -> int:
+        """How many times a target was marked dirty; unchanged between two calls means no local change in between"""
+        with self._condition:
+            return self._changes.get(target, 0)
+
+    def pending(self) -> list:
+        """Targets waiting to be uploaded or being uploaded right now"""
+        with self._condition:
+            return list(self._dirty.keys() | self._uploading)
+
+    def flush(self) -> bool:
+        """Upload every dirty target right now. Returns True if all uploads succeeded"""
+        with self._flush_lock:
+            with self._condition:
+                targets = list(self._dirty)
+                self._dirty.clear()
+                self._uploading.update(targets)
+
+            success = True
+            for target in targets:
+                try:
+                    ok = self.flush_callbacks[target]()
+                except Exception as e:
+                    logger.error(f"Error flushing {target}: {e}")
+                    ok = False
+
+                with self._condition:
+                    self._uploading.discard(target)
+                    if not ok:
+                        # Keep it dirty so the next window retries the upload
+                        now = time.monotonic()
+                        self._dirty.setdefault(target, now)
+                        self._last_change = max(self._last_change, now)
+                if ok:
+                    logger.info(f"Synced {target} to Google Drive")
+                else:
+                    success = False
+            return success
+
+    def stop(self, flush: bool = True):
+        """Stop the worker, uploading pending changes first"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread:
+            self._thread.join(timeout=5)
+        if flush and self.pending():
+            logger.info("Flushing pending changes before shutdown...")
+            self.flush()
+
+    def _seconds_until_due(self) -> float:
+        """Time left before the current batch must be flushed (called under the condition lock)"""
+        now = time.monotonic()
+        oldest = min(self._dirty.values())
+        quiet_deadline = self._last_change + self.debounce_seconds
+        hard_deadline = oldest + self.max_delay_seconds
+        return min(quiet_deadline, hard_deadline) - now
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    if not self._dirty:
+                        self._condition.wait()
+                        continue
+                    remaining = self._seconds_until_due()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(timeout=remaining)
+                if self._stopping:
+                    return
+
+            self.flush()
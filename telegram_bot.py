@@ -1,21 +1,47 @@
 import os
 import logging
 import asyncio
+import time
 import threading
+import tempfile
 import http.server
 import socketserver
 from typing import Dict, List, Optional
 import pandas as pd
 import requests
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, InlineQueryResultArticle, InputTextMessageContent
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, InlineQueryHandler, filters
+from telegram.error import BadRequest
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaFileUpload, HttpRequest
+import google_auth_httplib2
+import httplib2
 import json
-import openpyxl
 from openpyxl import load_workbook
 from io import BytesIO
+import executors
+from executors import run_io
+from excel_io import write_excel, workbook_stamp
+from file_cache import FileIdCache
+from checksums import file_md5
+from image_manifest import ImageEntry, ImageManifest
+from inventory_aggregates import LOW_STOCK
+import image_pipeline
+from inventory_model import InstrumentTable, format_quantity
+from inventory_store import InventoryStore, HISTORY_FIELDS
+from query_cache import VersionedCache
+from search_normalize import normalize_text
+from sheet_diff import diff_rows, row_hash
+from sync_worker import SyncWorker
+
+# A CPU pool worker started with 'spawn' re-runs this script under this name (see executors):
+# it only needs the definitions, not the bot
+POOL_WORKER = __name__ == '__mp_main__'
+
+# Fork the Excel worker process before any other thread is started
+if not POOL_WORKER:
+    executors.warm_up()
 
 # Configure logging
 logging.basicConfig(
@@ -33,9 +59,24 @@ class HealthHandler(http.server.BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(b'OK')
     
+    def _readiness(self):
+        """(status code, body) for /ready: 200 once inventory data can be served"""
+        inventory_bot = globals().get('bot')
+        if inventory_bot is None or not inventory_bot.ready.is_set():
+            return 503, b'STARTING'
+        if not inventory_bot.reconciled.is_set():
+            return 200, b'READY (reconciling with Google Drive)'
+        return 200, b'READY'
+    
     def do_GET(self):
         if self.path == '/' or self.path == '/health':
             self._send_ok_response()
+        elif self.path == '/ready':
+            status, body = self._readiness()
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.end_headers()
+            self.wfile.write(body)
         else:
             self.send_response(404)
             self.end_headers()
@@ -46,6 +87,10 @@ class HealthHandler(http.server.BaseHTTPRequestHandler):
             self.send_response(200)
             self.send_header('Content-Type', 'text/plain; charset=utf-8')
             self.end_headers()
+        elif self.path == '/ready':
+            self.send_response(self._readiness()[0])
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.end_headers()
         else:
             self.send_response(404)
             self.end_headers()
@@ -80,7 +125,8 @@ def start_health_server():
         print(f"❌ Failed to bind health server to port {port}")
 
 # call this before initializing the bot
-start_health_server()
+if not POOL_WORKER:
+    start_health_server()
 # --- end health server ---
 
 # Bot configuration
@@ -89,61 +135,253 @@ start_health_server()
 # Google Sheets API scopes
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
 
-def auto_resize_excel_columns(excel_file_path: str):
-    """Auto-resize Excel columns to fit content"""
-    try:
-        workbook = openpyxl.load_workbook(excel_file_path)
-        worksheet = workbook.active
-        
-        # Auto-resize columns based on content
-        for column in worksheet.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            
-            for cell in column:
-                try:
-                    if cell.value:
-                        cell_length = len(str(cell.value))
-                        if cell_length > max_length:
-                            max_length = cell_length
-                except:
-                    pass
-            
-            # Set column width (add some padding)
-            adjusted_width = min(max_length + 2, 50)  # Max width 50 characters
-            worksheet.column_dimensions[column_letter].width = adjusted_width
-        
-        workbook.save(excel_file_path)
-        logger.info(f"Auto-resized columns in {excel_file_path}")
-        
-    except Exception as e:
-        logger.error(f"Error auto-resizing columns in {excel_file_path}: {e}")
+# Write-behind sync: a burst of edits becomes one Drive upload per window
+SYNC_DEBOUNCE_SECONDS = float(os.getenv('SYNC_DEBOUNCE_SECONDS', '15'))
+SYNC_MAX_DELAY_SECONDS = float(os.getenv('SYNC_MAX_DELAY_SECONDS', '60'))
+
+# Start-up reconciliation is retried with backoff; after the last attempt edits go ahead on the local data
+RECONCILE_RETRY_SECONDS = float(os.getenv('RECONCILE_RETRY_SECONDS', '30'))
+RECONCILE_ATTEMPTS = int(os.getenv('RECONCILE_ATTEMPTS', '4'))
+
+# SQLite store: the source of truth; the .xlsx files are exported from it
+LOCAL_DB_FILE = os.getenv('LOCAL_DB_FILE', 'inventory.db')
+
+# Drive metadata that tells whether a remote file changed since we last saw it, and what kind of file it is
+REMOTE_FILE_FIELDS = 'md5Checksum,modifiedTime,version,mimeType'
+
+# The inventory and history files are either .xlsx uploads or native Google Sheets. Only a native
+# Sheet takes cell updates and appended rows through the values API (and is downloaded with
+# files().export); an .xlsx file is downloaded as is and replaced by a whole-workbook upload
+XLSX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+GOOGLE_SHEET_MIME_TYPE = 'application/vnd.google-apps.spreadsheet'
+
+# Range the history sheet is read from and appended to (6 columns)
+HISTORY_SHEET_RANGE = 'Sheet1!A:F'
+
+# Socket timeout for every Google API request, so a hung call cannot stall a worker forever
+GOOGLE_HTTP_TIMEOUT = float(os.getenv('GOOGLE_HTTP_TIMEOUT', '30'))
+
+# Search shows the most relevant matches only (10 pages of 5)
+SEARCH_RESULT_LIMIT = 50
+
+# Inline mode (@bot query): Telegram shows at most 50 results per answer and keeps them for cache_time
+INLINE_RESULT_LIMIT = 200
+INLINE_PAGE_SIZE = 50
+INLINE_CACHE_SECONDS = 10
+# Public address of image_server.py, for inline thumbnails (e.g. http://1.2.3.4:8080); optional
+IMAGE_SERVER_URL = os.getenv('IMAGE_SERVER_URL', '').rstrip('/')
 
 class InventoryBot:
     def __init__(self):
         self.service = None
         self.drive_service = None
-        self.inventory_data = None
+        self.instruments = None  # InstrumentTable, loaded from the store; only changed on self.loop
+        self.loop = None  # Event loop the handlers run on, see apply_in_memory()
         self.google_sheet_id = GOOGLE_SHEET_ID  # Inventory sheet ID
         self.history_sheet_id = HISTORY_SHEET_ID  # Separate history sheet ID
         self.user_states = {}  # Для отслеживания состояний пользователей
-        self.history_data = []  # Store history data in memory (list of dicts)
-        self.setup_google_services()
-        logger.info("About to download inventory Excel...")
-        self.download_excel_from_google_drive()  # Download latest Excel from Google Drive on startup
-        logger.info("About to download history Excel...")
-        self.download_history_from_google_drive()  # Download history Excel from Google Drive on startup
-        logger.info("Done downloading files.")
+        self.history_count = 0  # Entries in the history journal (the journal itself stays in the store)
+        self.history_exported_id = None  # Last journal row already written to LOCAL_HISTORY_FILE
+        self.inventory_version = 0  # Bumped on every inventory change or import
+        self.inventory_exported_version = None  # inventory_version already written to LOCAL_EXCEL_FILE
+        self.file_lock = threading.RLock()  # Serializes store writes (and their in-memory changes) and local Excel writes
+        self.ready = threading.Event()  # Inventory is loaded and can be served (possibly stale)
+        self.reconciled = threading.Event()  # Background reconciliation with Google Drive has finished
+        self.store = InventoryStore(LOCAL_DB_FILE)
+        self.file_cache = FileIdCache(self.store)
+        self.images = ImageManifest()  # Instrument number -> image files, built below
+        self.inline_cache = VersionedCache(max_entries=512, ttl=600)  # Inline answers per query and inventory_version
+        self.page_cache = VersionedCache(max_entries=1024, ttl=24 * 3600)  # Rendered list/table pages per inventory_version
+        self.sync_worker = SyncWorker(
+            {
+                'inventory': self.sync_inventory,
+                'history': self.sync_history,
+            },
+            debounce_seconds=SYNC_DEBOUNCE_SECONDS,
+            max_delay_seconds=SYNC_MAX_DELAY_SECONDS,
+        )
         
-        # Load history from local Excel file
+        # Serve right away from the local store (seeded from the bundled workbooks on a fresh disk);
+        # Google Drive is reconciled in the background
+        if self.store.instrument_count() == 0:
+            self.import_local_inventory()
+        if self.store.history_count() == 0:
+            self.import_local_history()
+        if self.store.get_meta('history_synced_id') is None:
+            self.store.set_meta('history_synced_id', self.store.last_history_id())
+        
+        if self.instruments is None:
+            self.load_local_inventory()
+        self.refresh_images()
+        
+        # History stays in the store; only its size is kept in memory
         try:
-            self.history_data = self.load_local_history()
-            if self.history_data:
-                logger.info(f"✅ Loaded {len(self.history_data)} history entries from local history file")
+            self.history_count = self.store.history_count()
+            if self.history_count:
+                logger.info(f"✅ History journal has {self.history_count} entries")
             else:
                 logger.info("⚠️ No history entries found")
         except Exception as e:
             logger.error(f"❌ Error loading history: {e}")
+        
+        self.ready.set()
+        threading.Thread(target=self.reconcile_with_drive, name='drive-reconcile', daemon=True).start()
+        threading.Thread(target=self.normalize_images, name='image-ingest', daemon=True).start()
+    
+    def reconcile_with_drive(self):
+        """Background start-up step: connect to Google, pull newer Drive files and swap them in.
+        
+        The sync worker starts afterwards, so nothing is uploaded before the
+        local data has been compared with Drive. Edits are refused until then
+        (edits_allowed): on a fresh disk the store holds the workbook bundled
+        with the code, and an edit on top of it would be uploaded over the
+        newer Drive file. A Drive that still cannot be read after
+        RECONCILE_ATTEMPTS (bad file ID, revoked access) does not keep the bot
+        read-only: edits then go ahead on the local data.
+        """
+        try:
+            self.setup_google_services()
+            if not self.drive_service:
+                return
+            
+            # History rows that never reached the sheet (e.g. after a crash) go out before the download replaces them
+            if self.service and self.store.history_since(self.history_synced_id()):
+                logger.info("Pushing unsynced history entries...")
+                self.sync_history()
+            
+            # Nothing can be pending yet, so both files are compared with Drive
+            for attempt in range(RECONCILE_ATTEMPTS):
+                if self.pull_from_drive():
+                    logger.info("Reconciled local data with Google Drive")
+                    break
+                if attempt + 1 < RECONCILE_ATTEMPTS:
+                    delay = min(RECONCILE_RETRY_SECONDS * 2 ** attempt, 600)
+                    logger.warning(f"Could not read Google Drive, edits stay disabled; retrying in {delay:.0f}s")
+                    time.sleep(delay)
+            else:
+                logger.error(f"Google Drive could not be read after {RECONCILE_ATTEMPTS} attempts; "
+                             f"allowing edits on the local data")
+            
+        except Exception as e:
+            logger.error(f"Error reconciling with Google Drive: {e}")
+        finally:
+            self.reconciled.set()
+            self.sync_worker.start()
+    
+    def edits_allowed(self) -> bool:
+        """False until the start-up reconciliation with Drive has finished"""
+        if not self.reconciled.is_set():
+            logger.warning("Edit refused: local data is not reconciled with Google Drive yet")
+            return False
+        return True
+    
+    def pull_from_drive(self) -> bool:
+        """Download the inventory and history files if they changed on Drive and swap them in.
+        
+        Returns False if a download failed; see pull_drive_file.
+        """
+        logger.info("About to download inventory Excel...")
+        success = self.download_excel_from_google_drive()
+        logger.info("About to download history Excel...")
+        success = self.download_history_from_google_drive() and success
+        return success
+    
+    def refresh_images(self):
+        """Index stored images and move legacy image{N}.* files into the content-addressed store"""
+        try:
+            for number, (digest, image_format) in self.store.image_refs().items():
+                entry = self.stored_image(number, digest, image_format)
+                if entry:
+                    self.images.set_reference(entry)
+                else:
+                    self.images.remove_reference(number)
+            
+            # A legacy file is (re)imported when it is new, or was replaced after the stored image;
+            # files left behind by deleted instruments stay where they are
+            self.images.refresh()
+            migrated = 0
+            for legacy in self.images.legacy_entries():
+                if self.instruments is not None and legacy.number not in self.instruments:
+                    continue
+                current = self.images.reference(legacy.number)
+                if current is None or (legacy.digest != current.digest and legacy.mtime_ns > current.mtime_ns):
+                    if self.store_image(legacy.number, legacy.path, legacy.digest):
+                        migrated += 1
+            if migrated:
+                logger.info(f"Moved {migrated} legacy image file(s) into the image store")
+            
+            for digest, paths in image_pipeline.scan_media().items():
+                self.images.set_variants(digest, paths)
+        except Exception as e:
+            logger.error(f"Error building image manifest: {e}")
+    
+    def stored_image(self, number: int, digest: str, image_format: str) -> Optional[ImageEntry]:
+        """Manifest entry for an image in the store, or None if its file is missing"""
+        path = image_pipeline.blob_path(digest, image_format)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return ImageEntry(int(number), path, image_format, stat.st_size, stat.st_mtime_ns, digest)
+    
+    def store_image(self, number: int, source_path: str, digest: Optional[str] = None, move: bool = False) -> Optional[ImageEntry]:
+        """Put an image into the content-addressed store (once per unique content) and point the instrument at it"""
+        digest = digest or file_md5(source_path)
+        image_format = image_pipeline.sniff_format(source_path)
+        if image_format is None:
+            logger.warning(f"Unknown image format: {source_path}")
+            return None
+        image_pipeline.store_blob(source_path, digest, image_format, move=move)
+        self.store.set_image_ref(number, digest, image_format)
+        entry = self.stored_image(number, digest, image_format)
+        if entry:
+            self.images.set_reference(entry)
+        return entry
+    
+    def ingest_image(self, path: str, number: int) -> bool:
+        """Store a newly received image for an instrument and produce its optimized variants in the CPU pool"""
+        entry = self.store_image(number, path, move=True)
+        if entry is None:
+            return False
+        if not image_pipeline.available() or self.images.has_variants(entry.digest, image_pipeline.VARIANTS):
+            return True
+        try:
+            paths = executors.call_cpu(image_pipeline.normalize_image, entry.path, entry.digest)
+            self.images.set_variants(entry.digest, paths)
+            return True
+        except Exception as e:
+            logger.error(f"Error normalizing image {path}: {e}")
+            return False
+    
+    def normalize_images(self):
+        """Background start-up step: produce variants for every image that has none yet"""
+        if not image_pipeline.available():
+            logger.warning("Pillow is not installed: images are sent as original files")
+            return
+        # One entry per unique digest: identical pictures are normalized once
+        pending = [entry for entry in self.images.entries() if not self.images.has_variants(entry.digest, image_pipeline.VARIANTS)]
+        for entry in pending:
+            try:
+                paths = executors.call_cpu(image_pipeline.normalize_image, entry.path, entry.digest)
+                self.images.set_variants(entry.digest, paths)
+            except Exception as e:
+                logger.error(f"Error normalizing image {entry.path}: {e}")
+        if pending:
+            logger.info(f"Normalized images: {len(pending)} file(s) processed")
+    
+    def build_google_service(self, api: str, version: str, credentials):
+        """Build an API client that is safe to use from several threads.
+        
+        httplib2 connections are not thread-safe, so every request gets its own
+        authorized Http object, each with GOOGLE_HTTP_TIMEOUT as socket timeout.
+        """
+        def new_http():
+            return google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT))
+        
+        def build_request(http, *args, **kwargs):
+            return HttpRequest(new_http(), *args, **kwargs)
+        
+        return build(api, version, http=new_http(), requestBuilder=build_request)
     
     def setup_google_services(self):
         """Setup Google Sheets and Drive API connections"""
@@ -154,26 +392,32 @@ class InventoryBot:
                 credentials_data = json.loads(os.getenv('SERVICE_ACCOUNT_JSON'))
                 credentials = service_account.Credentials.from_service_account_info(
                     credentials_data, scopes=SCOPES)
-                self.service = build('sheets', 'v4', credentials=credentials)
-                self.drive_service = build('drive', 'v3', credentials=credentials)
+                self.service = self.build_google_service('sheets', 'v4', credentials)
+                self.drive_service = self.build_google_service('drive', 'v3', credentials)
                 logger.info("Google services initialized with environment variable")
             elif os.path.exists('service_account.json'):
                 credentials = service_account.Credentials.from_service_account_file(
                     'service_account.json', scopes=SCOPES)
-                self.service = build('sheets', 'v4', credentials=credentials)
-                self.drive_service = build('drive', 'v3', credentials=credentials)
+                self.service = self.build_google_service('sheets', 'v4', credentials)
+                self.drive_service = self.build_google_service('drive', 'v3', credentials)
                 logger.info("Google services initialized with service account file")
             else:
                 logger.warning("No service account found. Google Sheets sync will be disabled.")
         except Exception as e:
             logger.error(f"Error setting up Google services: {e}")
     
-    def load_local_inventory(self) -> pd.DataFrame:
-        """Load inventory data from local Excel file Sheet1"""
+    def import_local_inventory(self) -> bool:
+        """Import the local Excel file Sheet1 into the store, replacing all instruments"""
         try:
             if not os.path.exists(LOCAL_EXCEL_FILE):
                 logger.error(f"Local Excel file '{LOCAL_EXCEL_FILE}' not found")
-                return pd.DataFrame()
+                return False
+            
+            # Same bytes as the last import or export: the store already has this data (or newer)
+            stamp = workbook_stamp(LOCAL_EXCEL_FILE)
+            if self.store.instrument_count() and stamp == self.store.get_meta('inventory_workbook_md5'):
+                logger.info("Inventory workbook unchanged since the last import/export, keeping the store")
+                return True
             
             # Load Excel file Sheet1 (inventory)
             df = pd.read_excel(LOCAL_EXCEL_FILE, sheet_name=0)  # sheet_name=0 is Sheet1
@@ -186,21 +430,56 @@ class InventoryBot:
                 if df[col].dtype == 'object':  # Text columns
                     df[col] = df[col].replace(0, '')
             
-            self.inventory_data = df
-            logger.info(f"Loaded {len(df)} instruments from local Excel file")
+            self.store.replace_inventory(df)
+            self.store.set_meta('inventory_workbook_md5', stamp)
+            # The imported workbook is what the sheet holds now
+            self.mark_inventory_synced(*self.store.inventory_cells())
+            # The workbook on disk is exactly what was just imported
+            self.load_local_inventory(exported=True)
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error importing local inventory: {e}")
+            return False
+    
+    def load_local_inventory(self, exported: bool = False) -> InstrumentTable:
+        """Load inventory data from the store into memory; `exported` if LOCAL_EXCEL_FILE already holds it"""
+        try:
+            started = time.perf_counter()
             
-            # CRITICAL: DO NOT reload Sheet2 here - it's already loaded in __init__ and stored in memory
-            # Only reload Sheet2 if we explicitly want to (which we don't here)
+            # The version moves together with the table, so no page is cached under it with the old data
+            def swap():
+                self.instruments = table
+                self.inventory_version += 1
+                if exported:
+                    self.inventory_exported_version = self.inventory_version
             
-            return df
+            # Under the lock, so the swap is queued behind the in-memory changes of earlier store writes
+            with self.file_lock:
+                table = InstrumentTable.from_rows(self.store.instrument_rows())
+                self.apply_in_memory(swap)
+            logger.info(f"Loaded {len(table)} instruments from the store in {(time.perf_counter() - started) * 1000:.1f} ms")
+            # Search indexes are built in the background; a search before they are ready builds them itself
+            threading.Thread(target=self.build_search_indexes, args=(table,), name='search-index', daemon=True).start()
+            return table
             
         except Exception as e:
             logger.error(f"Error loading local inventory: {e}")
-            return pd.DataFrame()
+            return InstrumentTable()
+    
+    def build_search_indexes(self, table: InstrumentTable):
+        """Background step after a load: build the table's search indexes and hand them over on the loop"""
+        try:
+            started = time.perf_counter()
+            indexes = table.build_indexes()
+            self.apply_in_memory(lambda: table.install_indexes(*indexes))
+            logger.info(f"Built search indexes for {len(table)} instruments in {(time.perf_counter() - started) * 1000:.1f} ms")
+        except Exception as e:
+            logger.error(f"Error building search indexes: {e}")
     
     def create_or_update_google_sheet(self):
         """Create or update Google Sheet from local data"""
-        if not self.service or self.inventory_data is None:
+        if not self.service or self.instruments is None:
             logger.warning("Cannot create Google Sheet - missing service or data")
             return
         
@@ -251,152 +530,289 @@ class InventoryBot:
             return False
     
     def update_google_sheet(self):
-        """Update Google Sheet by uploading the updated Excel file"""
-        if not self.drive_service or not self.google_sheet_id or self.inventory_data is None:
-            logger.warning("Google Drive service not available")
+        """Update Google Sheet with the cells that changed since the last sync"""
+        if not self.service or not self.google_sheet_id or self.instruments is None:
+            logger.warning("Google Sheets service not available")
             return False
         
+        return self.sync_inventory()
+    
+    def sync_inventory(self) -> bool:
+        """Sync worker callback: export the inventory workbook and push changed cells to the sheet.
+        
+        Uploads the whole workbook instead when the inventory file is an .xlsx
+        upload (see is_native_sheet), or when the cell update fails.
+        """
+        # Capture the data first: anything changed after this point goes out with the next flush
+        columns, rows = self.store.inventory_cells()
+        if not self.save_local_inventory():
+            return False
+        if not self.service:
+            return True
+        if self.is_native_sheet('inventory') and self.push_inventory_changes(columns, rows):
+            return True
+        if not self.drive_service or not self.upload_inventory_to_google_drive():
+            return False
+        self.mark_inventory_synced(columns, rows)
+        return True
+    
+    def mark_inventory_synced(self, columns: list, rows: list):
+        """Record these inventory rows as the current content of the sheet"""
+        synced_columns, synced_rows = self.store.sheet_snapshot()
+        changed = []
+        for position, (number, cells) in enumerate(rows):
+            cell_hash = row_hash(cells)
+            synced = synced_rows[position] if position < len(synced_rows) else None
+            if synced is None or synced[0] != number or synced[1] != cell_hash:
+                changed.append((position, number, cell_hash, cells))
+        self.store.update_sheet_snapshot(columns, changed, len(rows))
+    
+    def push_inventory_changes(self, columns: list, rows: list) -> bool:
+        """Send cells that differ from the last synced snapshot in one values().batchUpdate request"""
         try:
-            # First, save the current data to local Excel file
-            self.save_local_inventory()
+            synced_columns, synced_rows = self.store.sheet_snapshot()
+            data = diff_rows(columns, rows, synced_columns, synced_rows)
+            if not data:
+                return True
             
-            # Upload the updated Excel file to Google Drive
-            file_metadata = {
-                'name': LOCAL_EXCEL_FILE
-            }
+            self.service.spreadsheets().values().batchUpdate(
+                spreadsheetId=self.google_sheet_id,
+                body={'valueInputOption': 'RAW', 'data': data}
+            ).execute()
             
-            media = MediaFileUpload(LOCAL_EXCEL_FILE, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+            self.mark_inventory_synced(columns, rows)
+            logger.info(f"Updated {len(data)} ranges in the inventory sheet")
+            return True
             
-            # Update the existing file in Google Drive
-            self.drive_service.files().update(
-                fileId=self.google_sheet_id,
-                body=file_metadata,
-                media_body=media
+        except Exception as e:
+            logger.error(f"Error updating the inventory sheet: {e}")
+            return False
+    
+    def sync_history(self) -> bool:
+        """Sync worker callback: append new history rows to the history sheet.
+        
+        Exports and uploads the whole workbook instead when the history file
+        is an .xlsx upload (see is_native_sheet), or when the append fails.
+        """
+        if not self.service:
+            return True
+        if self.is_native_sheet('history') and self.append_history_to_sheet():
+            return True
+        if not self.drive_service or not self.save_local_history():
+            return False
+        if not self.upload_history_to_google_drive():
+            return False
+        self.store.set_meta('history_synced_id', self.history_exported_id)
+        return True
+    
+    def history_synced_id(self) -> int:
+        """Last journal row id known to be in the history sheet"""
+        return int(self.store.get_meta('history_synced_id', '0'))
+    
+    def append_history_to_sheet(self) -> bool:
+        """Append journal rows the sheet does not have yet, in a single values().append request"""
+        try:
+            rows = self.store.history_since(self.history_synced_id())
+            if not rows:
+                return True
+            
+            values = [[row[field] for field in HISTORY_FIELDS] for row in rows]
+            self.service.spreadsheets().values().append(
+                spreadsheetId=self.history_sheet_id,
+                range=HISTORY_SHEET_RANGE,
+                valueInputOption='RAW',  # user-typed text is never evaluated as a formula
+                insertDataOption='INSERT_ROWS',
+                body={'values': values}
             ).execute()
             
-            logger.info(f"Updated Excel file in Google Drive: {self.google_sheet_id}")
+            self.store.set_meta('history_synced_id', rows[-1]['id'])
+            logger.info(f"Appended {len(values)} history rows to the sheet")
             return True
             
         except Exception as e:
-            logger.error(f"Error updating Google Sheet: {e}")
+            logger.error(f"Error appending history to the sheet: {e}")
             return False
     
-    def download_excel_from_google_drive(self) -> bool:
-        """Download the latest Excel file from Google Drive and overwrite local copy"""
-        if not self.drive_service:
+    def upload_inventory_to_google_drive(self) -> bool:
+        """Upload the already saved local inventory Excel file to Google Drive"""
+        if not self.drive_service or not self.google_sheet_id:
             logger.warning("Google Drive service not available")
             return False
         
         try:
-            logger.info(f"Downloading Excel file from Google Drive: {self.google_sheet_id}")
-            
-            # Request the file content (get_media for native files, not export_media)
-            request = self.drive_service.files().get_media(
-                fileId=self.google_sheet_id
-            )
-            
-            # Download the file content
-            excel_content = request.execute()
-            
-            # Save to local file
-            with open(LOCAL_EXCEL_FILE, 'wb') as f:
-                f.write(excel_content)
+            # Upload the updated Excel file to Google Drive
+            file_metadata = {
+                'name': LOCAL_EXCEL_FILE
+            }
             
-            logger.info(f"Successfully downloaded Excel file from Google Drive")
+            # Files are replaced atomically, so the opened handle stays consistent
+            with self.file_lock:
+                media = MediaFileUpload(LOCAL_EXCEL_FILE, mimetype=XLSX_MIME_TYPE)
             
-            # Auto-resize columns after download
-            auto_resize_excel_columns(LOCAL_EXCEL_FILE)
+            # Update the existing file in Google Drive
+            result = self.drive_service.files().update(
+                fileId=self.google_sheet_id,
+                body=file_metadata,
+                media_body=media,
+                fields=REMOTE_FILE_FIELDS
+            ).execute()
+            # Our own upload should not trigger a download on the next start
+            self.remember_remote_file('inventory_remote', result)
             
-            # Reload the local inventory after downloading
-            self.load_local_inventory()
+            logger.info(f"Updated Excel file in Google Drive: {self.google_sheet_id}")
             return True
             
         except Exception as e:
-            logger.error(f"Error downloading Excel from Google Drive: {e}")
+            logger.error(f"Error updating Google Sheet: {e}")
             return False
     
+    def remote_file_info(self, file_id: str) -> Optional[dict]:
+        """Checksum, modification time and version of a Drive file (None if unavailable)"""
+        try:
+            return self.drive_service.files().get(fileId=file_id, fields=REMOTE_FILE_FIELDS).execute()
+        except Exception as e:
+            logger.warning(f"Could not read Drive metadata for {file_id}: {e}")
+            return None
+    
+    def remember_remote_file(self, meta_key: str, info: Optional[dict]):
+        """Store the Drive metadata of the file version the store now matches"""
+        if info:
+            self.store.set_meta(meta_key, json.dumps(info, sort_keys=True))
+    
+    def remote_file_unchanged(self, meta_key: str, info: Optional[dict]) -> bool:
+        return bool(info) and self.store.get_meta(meta_key) == json.dumps(info, sort_keys=True)
+    
+    def is_native_sheet(self, target: str) -> bool:
+        """Whether the Drive file of 'inventory' or 'history' was a native Google Sheet when last seen"""
+        info = self.store.get_meta(f'{target}_remote')
+        return bool(info) and json.loads(info).get('mimeType') == GOOGLE_SHEET_MIME_TYPE
+    
+    def download_excel_from_google_drive(self) -> bool:
+        """Download the latest Excel file from Google Drive and import it, unless the store already matches it"""
+        return self.pull_drive_file('inventory', self.google_sheet_id, LOCAL_EXCEL_FILE,
+                                    self.import_local_inventory, self.store.instrument_count() > 0)
+    
     def download_history_from_google_drive(self) -> bool:
-        """Download the history Excel file from Google Drive and overwrite local copy"""
+        """Download the history Excel file from Google Drive and import it, unless the store already matches it"""
+        return self.pull_drive_file('history', self.history_sheet_id, LOCAL_HISTORY_FILE,
+                                    self.import_local_history, self.store.history_count() > 0)
+    
+    def pull_drive_file(self, target: str, file_id: str, local_file: str, import_file, have_local: bool) -> bool:
+        """Download a Drive file into a temporary file and import it as `local_file`.
+        
+        The download runs without file_lock, so edits are not held up by
+        Drive; only the swap-in takes the lock. A target with local changes
+        waiting for (or in the middle of) an upload, or changed while the
+        download ran, is left alone: those changes win and the sync worker
+        pushes them.
+        """
         if not self.drive_service:
             logger.warning("Google Drive service not available")
             return False
         
+        meta_key = f'{target}_remote'
+        changes = self.sync_worker.changes(target)
+        if target in self.sync_worker.pending():
+            logger.info(f"Local {target} changes are waiting for upload, skipping the download")
+            return True
+        path = None
         try:
-            logger.info(f"Downloading history Excel file from Google Drive: {self.history_sheet_id}")
+            info = self.remote_file_info(file_id)
+            if have_local and self.remote_file_unchanged(meta_key, info):
+                logger.info(f"{target.capitalize()} on Google Drive is unchanged, skipping download")
+                return True
             
-            # Request the file content
-            request = self.drive_service.files().get_media(
-                fileId=self.history_sheet_id
-            )
+            logger.info(f"Downloading {target} Excel file from Google Drive: {file_id}")
             
-            # Download the file content
+            # A native Google Sheet has no bytes of its own: it is exported as .xlsx
+            if info and info.get('mimeType') == GOOGLE_SHEET_MIME_TYPE:
+                request = self.drive_service.files().export_media(fileId=file_id, mimeType=XLSX_MIME_TYPE)
+            else:
+                request = self.drive_service.files().get_media(fileId=file_id)
             excel_content = request.execute()
-            
-            # Save to local file
-            with open(LOCAL_HISTORY_FILE, 'wb') as f:
+            fd, path = tempfile.mkstemp(suffix='.xlsx', dir=os.path.dirname(os.path.abspath(local_file)))
+            with os.fdopen(fd, 'wb') as f:
                 f.write(excel_content)
             
-            logger.info(f"Successfully downloaded history Excel file from Google Drive")
-            
-            # Auto-resize columns after download
-            auto_resize_excel_columns(LOCAL_HISTORY_FILE)
+            logger.info(f"Successfully downloaded {target} Excel file from Google Drive")
             
+            with self.file_lock:
+                if target in self.sync_worker.pending() or self.sync_worker.changes(target) != changes:
+                    logger.info(f"Local {target} changed during the download, keeping it")
+                    return True
+                os.replace(path, local_file)
+                path = None
+                # The downloaded workbook replaces the store contents
+                if not import_file():
+                    return False
+                self.remember_remote_file(meta_key, info)
             return True
             
         except Exception as e:
-            logger.error(f"Error downloading history Excel from Google Drive: {e}")
+            logger.error(f"Error downloading {target} Excel from Google Drive: {e}")
             return False
+        finally:
+            if path and os.path.exists(path):
+                os.remove(path)
     
-    def load_local_history(self) -> list:
-        """Load history from local Excel file"""
+    def import_local_history(self) -> bool:
+        """Import the local history Excel file into the store, replacing the history table"""
         try:
             if not os.path.exists(LOCAL_HISTORY_FILE):
                 logger.warning(f"Local history file '{LOCAL_HISTORY_FILE}' not found")
-                return []
+                return False
+            
+            # Same bytes as the last import or export: the store already has this history (or newer)
+            stamp = workbook_stamp(LOCAL_HISTORY_FILE)
+            if self.store.history_count() and stamp == self.store.get_meta('history_workbook_md5'):
+                logger.info("History workbook unchanged since the last import/export, keeping the store")
+                return True
             
             # Load Excel file
             df = pd.read_excel(LOCAL_HISTORY_FILE)
             
-            # Convert to list of dicts
-            history = []
-            for _, row in df.iterrows():
-                history.append({
-                    'number': str(row.iloc[0]) if len(row) > 0 else '',
-                    'name': str(row.iloc[1]) if len(row) > 1 else '',
-                    'action': str(row.iloc[2]) if len(row) > 2 else '',
-                    'instrument_name': str(row.iloc[3]) if len(row) > 3 else '',
-                    'change': str(row.iloc[4]) if len(row) > 4 else '',
-                    'time': str(row.iloc[5]) if len(row) > 5 else ''
-                })
+            # Convert to list of dicts (the first 6 columns, as text, in one pass)
+            history = [
+                dict(zip(HISTORY_FIELDS, values))
+                for values in df.iloc[:, :len(HISTORY_FIELDS)].astype(str).values.tolist()
+            ]
             
             # Skip header row if present
             if history and history[0]['number'] == '№':
                 history = history[1:]
             
-            return history
+            with self.file_lock:
+                self.store.replace_history(history)
+                self.history_count = len(history)
+                # The workbook on disk is exactly what was just imported, and what the sheet holds
+                self.history_exported_id = self.store.last_history_id()
+                self.store.set_meta('history_synced_id', self.history_exported_id)
+                self.store.set_meta('history_workbook_md5', stamp)
+            return True
             
         except Exception as e:
-            logger.error(f"Error loading local history: {e}")
-            return []
+            logger.error(f"Error importing local history: {e}")
+            return False
     
-    def save_local_history(self):
-        """Save history data to local Excel file"""
+    def save_local_history(self) -> bool:
+        """Export the history journal to the local Excel file, unless the file is already current"""
         try:
-            if not self.history_data:
-                return
-            
-            # Create DataFrame
-            df = pd.DataFrame(self.history_data)
-            
-            # Save to local Excel file
-            df.to_excel(LOCAL_HISTORY_FILE, index=False)
+            with self.file_lock:
+                last_id = self.store.last_history_id()
+                if last_id == self.history_exported_id and os.path.exists(LOCAL_HISTORY_FILE):
+                    return True
+                
+                # Save to local Excel file (with resized columns) in the CPU pool
+                df = self.store.history_frame()
+                executors.call_cpu(write_excel, df, LOCAL_HISTORY_FILE)
+                self.history_exported_id = last_id
+                self.store.set_meta('history_workbook_md5', workbook_stamp(LOCAL_HISTORY_FILE))
             logger.info("Saved history data to local Excel file")
-            
-            # Auto-resize columns
-            auto_resize_excel_columns(LOCAL_HISTORY_FILE)
+            return True
             
         except Exception as e:
             logger.error(f"Error saving local history: {e}")
+            return False
     
     def upload_history_to_google_drive(self) -> bool:
         """Upload history Excel file to Google Drive"""
@@ -405,22 +821,23 @@ class InventoryBot:
             return False
         
         try:
-            # Save local history first
-            self.save_local_history()
-            
-            # Upload to Google Drive
+            # Upload the already saved local history file to Google Drive
             file_metadata = {
                 'name': LOCAL_HISTORY_FILE
             }
             
-            media = MediaFileUpload(LOCAL_HISTORY_FILE, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+            # Files are replaced atomically, so the opened handle stays consistent
+            with self.file_lock:
+                media = MediaFileUpload(LOCAL_HISTORY_FILE, mimetype=XLSX_MIME_TYPE)
             
             # Update the existing file in Google Drive
-            self.drive_service.files().update(
+            result = self.drive_service.files().update(
                 fileId=self.history_sheet_id,
                 body=file_metadata,
-                media_body=media
+                media_body=media,
+                fields=REMOTE_FILE_FIELDS
             ).execute()
+            self.remember_remote_file('history_remote', result)
             
             logger.info(f"Uploaded history Excel file to Google Drive: {self.history_sheet_id}")
             return True
@@ -430,60 +847,137 @@ class InventoryBot:
             return False
     
     def update_instrument_amount(self, instrument_name: str, new_amount: str) -> bool:
-        """Update the amount of a specific instrument locally and in Google Sheets"""
+        """Update the amount of the instrument with this name and commit the change"""
+        if self.instruments is None:
+            self.load_local_inventory()
+        
+        instrument = self.instruments.find_by_name(instrument_name)
+        if instrument is None:
+            logger.error(f"Instrument '{instrument_name}' not found")
+            return False
+        return self.set_instrument_amount(instrument.number, new_amount)
+    
+    def set_instrument_amount(self, instrument_number: int, new_amount: str) -> bool:
+        """Update the amount of the instrument with this number and commit the change"""
+        if not self.edits_allowed():
+            return False
         try:
-            if self.inventory_data is None:
-                self.load_local_inventory()
+            number, quantity = int(instrument_number), float(new_amount)
+            with self.file_lock:
+                # Single-row update in the store (the table in memory may still be catching up), then the same change in memory
+                if not self.store.set_quantity(number, quantity):
+                    logger.error(f"Instrument №{number} not found")
+                    return False
+                logger.info(f"Updated instrument №{number} amount to {new_amount}")
+                return self.commit_inventory(lambda: self.instruments.set_quantity(number, quantity))
             
-            # Find the instrument in local data
-            instrument_found = False
-            for idx, row in self.inventory_data.iterrows():
-                # Check against the 'Наименование' column (column 1)
-                current_name = bot.safe_get_text(row, 1) if len(row) > 1 else bot.safe_get_text(row, 0)
-                if current_name.lower() == instrument_name.lower():
-                    # Update local Excel file - amount is in 'Количество' column (column 5)
-                    # Convert to float first to avoid dtype warning
-                    self.inventory_data.iloc[idx, 5] = float(new_amount)
-                    
-                    # Save to local Excel file and update Google Sheet
-                    self.save_local_inventory()
-                    self.update_google_sheet()
-                    
-                    instrument_found = True
-                    logger.info(f"Updated {instrument_name} amount to {new_amount}")
-                    break
-            
-            if not instrument_found:
-                logger.error(f"Instrument '{instrument_name}' not found")
-                return False
+        except Exception as e:
+            logger.error(f"Error updating instrument amount: {e}")
+            return False
+    
+    def add_instrument(self, new_row: dict) -> bool:
+        """Append a new instrument row and commit the change"""
+        if not self.edits_allowed():
+            return False
+        try:
+            with self.file_lock:
+                number = self.store.insert_instrument(new_row)
+                logger.info(f"Added instrument №{number} {new_row.get('Наименование', '')}")
+                return self.commit_inventory(lambda: self.instruments.add(
+                    number,
+                    new_row.get('Наименование', ''),
+                    new_row.get('Модель', ''),
+                    new_row.get('Компания производителя', ''),
+                    new_row.get('Характеристика ', ''),
+                    new_row.get('Количество', 0),
+                    new_row.get('ImageURL', '')
+                ))
             
-            return True
+        except Exception as e:
+            logger.error(f"Error adding instrument: {e}")
+            return False
+    
+    def delete_instrument(self, instrument_number: int) -> bool:
+        """Delete the instrument with this number and commit the change"""
+        if not self.edits_allowed():
+            return False
+        try:
+            number = int(instrument_number)
+            with self.file_lock:
+                if not self.store.delete_instrument(number):
+                    return False
+                self.images.remove_reference(number)
+                logger.info(f"Deleted instrument №{number}")
+                return self.commit_inventory(lambda: self.instruments.remove(number))
             
         except Exception as e:
-            logger.error(f"Error updating instrument amount: {e}")
+            logger.error(f"Error deleting instrument: {e}")
             return False
     
-    def save_local_inventory(self):
-        """Save current inventory data to local Excel file, preserving Sheet2 (history)"""
+    def commit_inventory(self, change) -> bool:
+        """Apply the in-memory side of a change already committed to the store and queue a single sync.
+        
+        All mutations go through here, holding file_lock: `change` updates
+        the in-memory table the same way, so nothing is reloaded; the workbook
+        is exported from the store when the sync worker picks the change up.
+        """
+        def apply():
+            change()
+            self.inventory_version += 1
+        
+        self.apply_in_memory(apply)
+        self.queue_sync('inventory')
+        return True
+    
+    def attach_loop(self, loop: asyncio.AbstractEventLoop):
+        """Route in-memory inventory changes to the loop the handlers run on"""
+        self.loop = loop
+    
+    def apply_in_memory(self, change):
+        """Run a change of self.instruments (or a swap of it) on the event loop thread.
+        
+        Handlers read the table and its search indexes on the loop without any
+        lock, so worker threads never touch them: they write the store under
+        file_lock and post the matching change here. Callbacks run in the
+        order they were posted, which is the order of the store writes, and
+        before the awaiting handler resumes. Before the loop runs (start-up)
+        the change is applied right away.
+        """
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            change()
+            return
         try:
-            if self.inventory_data is not None:
-                # Clean data before saving
-                df_to_save = self.inventory_data.copy()
-                df_to_save = df_to_save.fillna(0)
-                
-                # For text columns, replace 0 with empty string
-                for col in df_to_save.columns:
-                    if df_to_save[col].dtype == 'object':  # Text columns
-                        df_to_save[col] = df_to_save[col].replace(0, '')
-                
-                # Save only inventory data (Sheet1), history is in separate file
-                df_to_save.to_excel(LOCAL_EXCEL_FILE, index=False)
-                logger.info("Saved inventory data to local Excel file")
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            change()
+        else:
+            loop.call_soon_threadsafe(change)
+    
+    def queue_sync(self, target: str):
+        """Mark 'inventory' or 'history' as dirty; the sync worker exports and uploads it after the debounce window"""
+        self.sync_worker.mark_dirty(target)
+    
+    def save_local_inventory(self) -> bool:
+        """Export the inventory from the store to the local Excel file, unless the file is already current"""
+        try:
+            # Save only inventory data (Sheet1), history is in separate file
+            with self.file_lock:
+                version = self.inventory_version
+                if version == self.inventory_exported_version and os.path.exists(LOCAL_EXCEL_FILE):
+                    return True
                 
-                # Auto-resize columns
-                auto_resize_excel_columns(LOCAL_EXCEL_FILE)
+                df_to_save = self.store.inventory_frame()
+                executors.call_cpu(write_excel, df_to_save, LOCAL_EXCEL_FILE)
+                self.inventory_exported_version = version
+                self.store.set_meta('inventory_workbook_md5', workbook_stamp(LOCAL_EXCEL_FILE))
+            logger.info("Saved inventory data to local Excel file")
+            return True
         except Exception as e:
             logger.error(f"Error saving local inventory: {e}")
+            return False
     
     def get_google_sheet_url(self) -> str:
         """Get the URL of the Google Sheet"""
@@ -497,18 +991,6 @@ class InventoryBot:
             return f"https://docs.google.com/spreadsheets/d/{self.history_sheet_id}"
         return "History Sheet not created yet"
 
-    def safe_get_text(self, row, col_index: int, default: str = "") -> str:
-        """Safely get text value from row, handling NaN values"""
-        try:
-            if len(row) > col_index:
-                value = row.iloc[col_index]
-                if pd.isna(value) or value == 0:
-                    return default
-                return str(value).strip()
-            return default
-        except:
-            return default
-
     def read_history_from_sheet(self) -> list:
         """Read history from separate history Google Sheet (6 columns)"""
         try:
@@ -516,7 +998,7 @@ class InventoryBot:
                 return []
             
             # Read from history sheet's first sheet, columns A-F (6 columns)
-            range_name = 'Sheet1!A:F'
+            range_name = HISTORY_SHEET_RANGE
             result = self.service.spreadsheets().values().get(
                 spreadsheetId=self.history_sheet_id,
                 range=range_name
@@ -545,39 +1027,42 @@ class InventoryBot:
             return []
     
     def write_history_to_sheet(self, entry_num: str, username: str, action: str, instrument_name: str, change: str, date_time: str):
-        """Write a new history entry locally and upload to Google Drive"""
+        """Write a new history entry locally and queue the upload to Google Drive"""
+        if not self.edits_allowed():
+            return
         try:
-            # Update in-memory history_data
-            self.history_data.append({
+            entry = {
                 'number': entry_num,
                 'name': username,
                 'action': action,
                 'instrument_name': instrument_name,
                 'change': change,
                 'time': date_time
-            })
-            logger.info(f"History data updated in memory. Total entries: {len(self.history_data)}")
-            
-            # Save to local Excel file
-            self.save_local_history()
-            
-            # Upload to Google Drive
-            self.upload_history_to_google_drive()
+            }
+            with self.file_lock:
+                # One INSERT into the append-only journal; the workbook is not touched here
+                self.store.append_history(entry)
+                self.history_count += 1
+                logger.info(f"History entry appended. Total entries: {self.history_count}")
+                # The workbook is exported and uploaded by the sync worker
+                self.queue_sync('history')
             
-            logger.info(f"History entry written and uploaded to Google Drive")
+            logger.info(f"History entry written and queued for Google Drive")
         except Exception as e:
             logger.error(f"Error writing history to sheet: {e}")
 
 # Initialize bot
-bot = InventoryBot()
+bot = None if POOL_WORKER else InventoryBot()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /start command"""
     keyboard = [
         [InlineKeyboardButton("📦 Просмотр инвентаря", callback_data="view_inventory")],
+        [InlineKeyboardButton("📋 Таблица инвентаря", callback_data="view_table")],
         [InlineKeyboardButton("🔍 Поиск инструментов", callback_data="search_instruments")],
         [InlineKeyboardButton("🆕 Добавить инструмент", callback_data="add_new_instrument")],
         [InlineKeyboardButton("📜 История изменений", callback_data="view_history")],
+        [InlineKeyboardButton("📊 Статистика", callback_data="statistics")],
         [InlineKeyboardButton("🔗 Ссылка на таблицу", callback_data="show_sheet_link")],
         [InlineKeyboardButton("🔄 Синхронизация", callback_data="force_sync")]
     ]
@@ -609,7 +1094,7 @@ def log_change(user_id: int, username: str, action_type: str, instrument_name: s
         name = f"@{username}" if username else f"User {user_id}"
         
         # Calculate next entry number
-        entry_num = str(len(bot.history_data) + 1)
+        entry_num = str(bot.history_count + 1)
         
         # Get current time
         date_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -624,9 +1109,9 @@ def log_change(user_id: int, username: str, action_type: str, instrument_name: s
 def get_change_history(limit: int = 3) -> list:
     """Get recent changes from history sheet"""
     try:
-        # Use in-memory history_data (already loaded from sheet)
+        # Only the last N entries are read from the journal
         history = []
-        for entry in bot.history_data[-limit:]:  # Get last N entries
+        for entry in bot.store.recent_history(limit):
             history.append({
                 'username': entry.get('name', ''),
                 'action': entry.get('action', ''),
@@ -640,6 +1125,31 @@ def get_change_history(limit: int = 3) -> list:
         print(f"Error loading history: {e}")
         return []
 
+async def reply_cached(message, kind: str, key: str, path: Optional[str] = None, url: Optional[str] = None, **kwargs):
+    """Send a photo or document by its cached Telegram file_id; upload `path` (or pass `url`) only on a miss.
+    
+    kind is 'photo' or 'document'. Returns the sent message.
+    """
+    send = message.reply_photo if kind == 'photo' else message.reply_document
+    file_id = bot.file_cache.get(key)
+    if file_id:
+        try:
+            return await send(**{kind: file_id}, **kwargs)
+        except BadRequest as e:
+            logger.warning(f"Cached file_id for {key} was rejected, uploading again: {e}")
+            bot.file_cache.forget(key)
+    
+    if path:
+        with open(path, 'rb') as f:
+            sent = await send(**{kind: f}, **kwargs)
+    else:
+        sent = await send(**{kind: url}, **kwargs)
+    
+    attachment = sent.photo[-1] if kind == 'photo' and sent.photo else getattr(sent, kind, None)
+    if attachment is not None:
+        bot.file_cache.put(key, attachment.file_id)
+    return sent
+
 async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show change history"""
     try:
@@ -702,14 +1212,15 @@ async def download_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     await query.answer()
     
     try:
-        # Send the local history Excel file
+        # Export the history from the store, then send the Excel file
+        await run_io(bot.save_local_history)
         if os.path.exists(LOCAL_HISTORY_FILE):
-            with open(LOCAL_HISTORY_FILE, 'rb') as f:
-                await query.message.reply_document(
-                    document=f,
-                    filename='История_изменений.xlsx',
-                    caption="📜 **История изменений**\n\nСкачайте файл Excel для просмотра полной истории."
-                )
+            key = f"document:history:{bot.store.get_meta('history_workbook_md5')}"
+            await reply_cached(
+                query.message, 'document', key, path=LOCAL_HISTORY_FILE,
+                filename='История_изменений.xlsx',
+                caption="📜 **История изменений**\n\nСкачайте файл Excel для просмотра полной истории."
+            )
             await query.answer("✅ Файл Excel отправлен!")
         else:
             await query.answer("❌ Файл истории не найден", show_alert=True)
@@ -729,7 +1240,7 @@ async def show_sheet_link(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await query.edit_message_text(
             f"🔗 <b>Ссылка на Google Таблицу</b>\n\n"
             f"📊 <b>Таблица:</b>\n{sheet_url}\n\n"
-            f"📊 <b>Инструментов:</b> {len(bot.inventory_data) if bot.inventory_data is not None else 0}\n\n"
+            f"📊 <b>Инструментов:</b> {len(bot.instruments) if bot.instruments is not None else 0}\n\n"
             f"Нажмите на ссылку выше, чтобы открыть таблицу в браузере.",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("📥 Скачать Excel", callback_data="download_inventory")],
@@ -752,14 +1263,16 @@ async def download_inventory(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     
     try:
-        # Send the local inventory Excel file
+        # Export the inventory from the store, then send the Excel file
+        await run_io(bot.save_local_inventory)
         if os.path.exists(LOCAL_EXCEL_FILE):
-            with open(LOCAL_EXCEL_FILE, 'rb') as f:
-                await query.message.reply_document(
-                    document=f,
-                    filename=LOCAL_EXCEL_FILE,
-                    caption=f"📊 **Инвентарь инструментов**\n\nСкачайте файл Excel для просмотра всех инструментов.\n\n📊 **Всего инструментов:** {len(bot.inventory_data) if bot.inventory_data is not None else 0}"
-                )
+            # The export checksum identifies this version of the workbook
+            key = f"document:inventory:{bot.store.get_meta('inventory_workbook_md5')}"
+            await reply_cached(
+                query.message, 'document', key, path=LOCAL_EXCEL_FILE,
+                filename=LOCAL_EXCEL_FILE,
+                caption=f"📊 **Инвентарь инструментов**\n\nСкачайте файл Excel для просмотра всех инструментов.\n\n📊 **Всего инструментов:** {len(bot.instruments) if bot.instruments is not None else 0}"
+            )
             await query.answer("✅ Файл Excel отправлен!")
         else:
             await query.answer("❌ Файл инвентаря не найден", show_alert=True)
@@ -1047,16 +1560,17 @@ async def handle_instrument_image(update: Update, context: ContextTypes.DEFAULT_
         # Получить изображение
         photo = update.message.photo[-1]  # Берем самое большое изображение
         
-        # Получить следующий номер изображения (максимальный номер + 1)
-        max_number = bot.inventory_data['№'].max() if not bot.inventory_data.empty else 0
-        next_image_number = max_number + 1
-        image_filename = f"image{next_image_number}.png"
+        # Зарезервировать номер будущего инструмента (номера удалённых не переиспользуются)
+        next_image_number = bot.user_states[user_id]['data'].get('number') or await run_io(bot.store.allocate_number)
+        bot.user_states[user_id]['data']['number'] = next_image_number
+        image_filename = f"upload_{next_image_number}_{photo.file_unique_id}.tmp"
         
         print(f"DEBUG: Saving image as {image_filename}")
         
-        # Скачать изображение
+        # Скачать изображение и положить в хранилище (одна копия на уникальное содержимое)
         file = await context.bot.get_file(photo.file_id)
         await file.download_to_drive(image_filename)
+        await run_io(bot.ingest_image, image_filename, next_image_number, timeout=executors.CPU_TIMEOUT_SECONDS)
         
         bot.user_states[user_id]['data']['image'] = image_filename
         
@@ -1096,13 +1610,9 @@ async def save_new_instrument(update: Update, context: ContextTypes.DEFAULT_TYPE
     print(f"📋 Data copied: {data}")
     
     try:
-        # Получить следующий номер инструмента (максимальный номер + 1)
-        max_number = bot.inventory_data['№'].max() if not bot.inventory_data.empty else 0
-        next_number = max_number + 1
-        
         # Создать новую строку для Excel
         new_row = {
-            '№': next_number,  # Номер инструмента
+            '№': data.get('number', 0),  # Номер, зарезервированный вместе с изображением (0 - выдаст хранилище)
             'Наименование': data['name'],  # Название
             'Модель': data['model'],  # Модель
             'Компания производителя': data['manufacturer'],  # Производитель
@@ -1111,19 +1621,13 @@ async def save_new_instrument(update: Update, context: ContextTypes.DEFAULT_TYPE
             'ImageURL': data.get('image_url', '')  # Ссылка на изображение
         }
         
-        # Добавить строку в DataFrame
-        new_df = pd.DataFrame([new_row])
-        bot.inventory_data = pd.concat([bot.inventory_data, new_df], ignore_index=True)
-        
-        # Сохранить в Excel
-        bot.save_local_inventory()
-        
-        # Обновить Google Sheet
-        bot.update_google_sheet()
+        # Добавить строку, сохранить и синхронизировать одним коммитом
+        if not await run_io(bot.add_instrument, new_row, timeout=None):
+            raise RuntimeError("не удалось сохранить инструмент")
         
         # Log the change
         username = update.effective_user.username or update.effective_user.first_name or f"User {user_id}"
-        log_change(user_id, username, "Добавление инструмента", data['name'], f"добавление инструмента")
+        await run_io(log_change, user_id, username, "Добавление инструмента", data['name'], f"добавление инструмента", timeout=None)
         
         # Очистить состояние пользователя ПОСЛЕ сохранения данных
         del bot.user_states[user_id]
@@ -1221,7 +1725,7 @@ async def search_instruments(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.edit_message_text(
         "🔍 **Поиск инструментов**\n\n"
         "Введите название инструмента для поиска.\n"
-        "Поиск работает по частичному совпадению.\n\n"
+        "Ищет по названию, модели, производителю и характеристикам, опечатки допускаются.\n\n"
         "Пример: 'термо' или 'контроллер'",
         reply_markup=reply_markup,
         parse_mode='Markdown'
@@ -1236,18 +1740,14 @@ async def handle_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     
     search_term = update.message.text.strip().lower()
-    inventory_data = bot.inventory_data
+    instruments = bot.instruments
     
-    if inventory_data is None or inventory_data.empty:
+    if not instruments:
         await update.message.reply_text("❌ Данные инвентаря не найдены.")
         return
     
-    # Search in instrument names (column 2)
-    matches = []
-    for idx, row in inventory_data.iterrows():
-        instrument_name = bot.safe_get_text(row, 1).lower()
-        if search_term in instrument_name and instrument_name:
-            matches.append((idx, row))
+    # Ranked fuzzy search over name, model, manufacturer and characteristics
+    matches = instruments.search(search_term, limit=SEARCH_RESULT_LIMIT)
     
     if not matches:
         await update.message.reply_text(
@@ -1294,16 +1794,16 @@ async def show_search_results(update: Update, context: ContextTypes.DEFAULT_TYPE
     result_text += f"Страница {page + 1} из {total_pages}\n\n"
     
     keyboard = []
-    for i, (idx, row) in enumerate(matches[start_idx:end_idx], start_idx + 1):
-        name = bot.safe_get_text(row, 1, "Неизвестно")
-        amount = bot.safe_get_text(row, 5, "0")
+    for i, instrument in enumerate(matches[start_idx:end_idx], start_idx + 1):
+        name = instrument.name.strip() or "Неизвестно"
+        amount = format_quantity(instrument.quantity)
         
         result_text += f"**{i}.** {name}\n"
         result_text += f"   Количество: {amount}\n\n"
         
         keyboard.append([InlineKeyboardButton(
             f"🔧 {name[:35]}...", 
-            callback_data=f"instrument_{idx}"
+            callback_data=f"instrument_{instrument.number}"
         )])
     
     # Add pagination buttons
@@ -1337,48 +1837,27 @@ async def statistics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     query = update.callback_query
     await query.answer()
     
-    inventory_data = bot.inventory_data
-    if inventory_data is None or inventory_data.empty:
+    instruments = bot.instruments
+    if not instruments:
         await query.edit_message_text("❌ Данные инвентаря не найдены.")
         return
     
-    # Calculate statistics
-    total_instruments = len(inventory_data)
-    
-    # Count by manufacturer (column 4)
-    manufacturers = {}
-    total_amount = 0
-    low_stock = 0
-    
-    for idx, row in inventory_data.iterrows():
-        if len(row) > 4:
-            manufacturer = str(row.iloc[4]).strip()
-            if manufacturer and manufacturer != 'nan':
-                manufacturers[manufacturer] = manufacturers.get(manufacturer, 0) + 1
-        
-        if len(row) > 6:
-            try:
-                amount = float(bot.safe_get_text(row, 6, "0"))
-                total_amount += amount
-                if amount < 5:  # Low stock threshold
-                    low_stock += 1
-            except:
-                pass
-    
-    # Top manufacturers
-    top_manufacturers = sorted(manufacturers.items(), key=lambda x: x[1], reverse=True)[:5]
+    # Aggregates are kept current by the inventory table, no scan needed
+    aggregates = instruments.aggregates
     
     stats_text = f"📊 **Статистика инвентаря**\n\n"
     stats_text += f"📦 **Общая информация:**\n"
-    stats_text += f"• Всего инструментов: {total_instruments}\n"
-    stats_text += f"• Общее количество: {total_amount:.0f}\n"
-    stats_text += f"• Низкий запас (<5): {low_stock}\n\n"
+    stats_text += f"• Всего инструментов: {aggregates.count}\n"
+    stats_text += f"• Общее количество: {aggregates.total_quantity:.0f}\n"
+    stats_text += f"• Низкий запас (<{LOW_STOCK}): {aggregates.low_stock}\n\n"
     
     stats_text += f"🏭 **Топ производители:**\n"
-    for i, (manufacturer, count) in enumerate(top_manufacturers, 1):
+    for i, (manufacturer, count) in enumerate(aggregates.top_manufacturers(5), 1):
         stats_text += f"{i}. {manufacturer}: {count} шт.\n"
     
     keyboard = [
+        [InlineKeyboardButton("📈 По производителям", callback_data="chart_manufacturers")],
+        [InlineKeyboardButton("📉 Уровни запасов", callback_data="chart_stock")],
         [InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1394,21 +1873,12 @@ async def chart_manufacturers(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     
-    inventory_data = bot.inventory_data
-    if inventory_data is None or inventory_data.empty:
+    instruments = bot.instruments
+    if not instruments:
         await query.edit_message_text("❌ Данные инвентаря не найдены.")
         return
     
-    # Count by manufacturer (column 4)
-    manufacturers = {}
-    for idx, row in inventory_data.iterrows():
-        if len(row) > 4:
-            manufacturer = str(row.iloc[4]).strip()
-            if manufacturer and manufacturer != 'nan':
-                manufacturers[manufacturer] = manufacturers.get(manufacturer, 0) + 1
-    
-    # Top manufacturers
-    top_manufacturers = sorted(manufacturers.items(), key=lambda x: x[1], reverse=True)[:10]
+    top_manufacturers = instruments.aggregates.top_manufacturers(10)
     
     chart_text = f"📈 **График по производителям**\n\n"
     chart_text += f"Топ-10 производителей:\n\n"
@@ -1435,34 +1905,18 @@ async def chart_stock(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     query = update.callback_query
     await query.answer()
     
-    inventory_data = bot.inventory_data
-    if inventory_data is None or inventory_data.empty:
+    instruments = bot.instruments
+    if not instruments:
         await query.edit_message_text("❌ Данные инвентаря не найдены.")
         return
     
-    # Analyze stock levels
-    stock_levels = {"Низкий (<5)": 0, "Средний (5-20)": 0, "Высокий (>20)": 0}
-    total_amount = 0
-    
-    for idx, row in inventory_data.iterrows():
-        if len(row) > 6:
-            try:
-                amount = float(bot.safe_get_text(row, 6, "0"))
-                total_amount += amount
-                if amount < 5:
-                    stock_levels["Низкий (<5)"] += 1
-                elif amount <= 20:
-                    stock_levels["Средний (5-20)"] += 1
-                else:
-                    stock_levels["Высокий (>20)"] += 1
-            except:
-                pass
+    aggregates = instruments.aggregates
     
     chart_text = f"📉 **График уровней запасов**\n\n"
-    chart_text += f"Общее количество: {total_amount:.0f}\n\n"
+    chart_text += f"Общее количество: {aggregates.total_quantity:.0f}\n\n"
     
-    for level, count in stock_levels.items():
-        percentage = (count / len(inventory_data)) * 100 if len(inventory_data) > 0 else 0
+    for level, count in aggregates.stock_buckets():
+        percentage = (count / aggregates.count) * 100 if aggregates.count > 0 else 0
         bar_length = int(percentage / 2)  # Scale for display
         bar = "█" * bar_length
         chart_text += f"{level:<15} {count:3} ({percentage:4.1f}%) {bar}\n"
@@ -1478,29 +1932,31 @@ async def chart_stock(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         parse_mode='Markdown'
     )
 
-async def view_table(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Show inventory table"""
-    query = update.callback_query
-    await query.answer()
-    
-    inventory_data = bot.inventory_data
-    if inventory_data is None or inventory_data.empty:
-        await query.edit_message_text("❌ Данные инвентаря не найдены.")
-        return
-    
-    # Get current page from callback data or set to 0
-    current_page = 0
-    if query.data.startswith("table_page_"):
-        try:
-            current_page = int(query.data.split('_')[2])  # table_page_0 -> 0
-        except (ValueError, IndexError):
-            current_page = 0
-    items_per_page = 10
+TABLE_ROWS_PER_PAGE = 10
+INVENTORY_BUTTONS_PER_PAGE = 5
+
+def cached_page(view: str, page: int, render):
+    """Rendered (text, reply_markup) of a browsing page, rendered once per inventory_version"""
+    version = bot.inventory_version
+    rendered = bot.page_cache.get((view, page), version)
+    if rendered is None:
+        rendered = render(page)
+        bot.page_cache.put((view, page), version, rendered)
+    return rendered
+
+def clamp_page(page: int, total_items: int, per_page: int) -> int:
+    """Buttons of an older message may point past the end once instruments were deleted"""
+    total_pages = max(1, (total_items + per_page - 1) // per_page)
+    return min(max(page, 0), total_pages - 1)
+
+def render_table_page(current_page: int):
+    ordered = bot.instruments.ordered()
+    items_per_page = TABLE_ROWS_PER_PAGE
     
     start_idx = current_page * items_per_page
     end_idx = start_idx + items_per_page
     
-    total_items = len(inventory_data)
+    total_items = len(ordered)
     total_pages = (total_items + items_per_page - 1) // items_per_page
     
     # Create table header
@@ -1515,10 +1971,10 @@ async def view_table(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     
     # Add table rows
     for i, idx in enumerate(range(start_idx, min(end_idx, total_items)), start_idx + 1):
-        row = inventory_data.iloc[idx]
-        name = bot.safe_get_text(row, 1, "0")[:22]
-        amount = bot.safe_get_text(row, 5, "0")[:8]
-        manufacturer = bot.safe_get_text(row, 3, "0")[:12]
+        instrument = ordered[idx]
+        name = (instrument.name.strip() or "0")[:22]
+        amount = format_quantity(instrument.quantity)[:8]
+        manufacturer = (instrument.manufacturer.strip() or "0")[:12]
         
         table_text += f"{i:<3} {name:<25} {amount:<10} {manufacturer:<15}\n"
     
@@ -1535,8 +1991,28 @@ async def view_table(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         keyboard.append(pagination_buttons)
     
     keyboard.append([InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return table_text, InlineKeyboardMarkup(keyboard)
+
+async def view_table(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show inventory table"""
+    query = update.callback_query
+    await query.answer()
+    
+    instruments = bot.instruments
+    if not instruments:
+        await query.edit_message_text("❌ Данные инвентаря не найдены.")
+        return
+    
+    # Get current page from callback data or set to 0
+    current_page = 0
+    if query.data.startswith("table_page_"):
+        try:
+            current_page = int(query.data.split('_')[2])  # table_page_0 -> 0
+        except (ValueError, IndexError):
+            current_page = 0
+    current_page = clamp_page(current_page, len(instruments), TABLE_ROWS_PER_PAGE)
     
+    table_text, reply_markup = cached_page('table', current_page, render_table_page)
     await query.edit_message_text(
         table_text,
         reply_markup=reply_markup,
@@ -1549,7 +2025,7 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await query.answer()
     
     settings_text = f"⚙️ **Настройки системы**\n\n"
-    settings_text += f"📊 **Загружено данных:** {len(bot.inventory_data) if bot.inventory_data is not None else 0} инструментов\n"
+    settings_text += f"📊 **Загружено данных:** {len(bot.instruments) if bot.instruments is not None else 0} инструментов\n"
     settings_text += f"📋 **Сервисный аккаунт:** {'✅ Доступен' if os.path.exists('service_account.json') else '❌ Не найден'}\n"
     settings_text += f"🌐 **Google Таблица:** {'✅ Подключена' if bot.google_sheet_id else '❌ Не подключена'}\n\n"
     
@@ -1578,16 +2054,21 @@ async def force_sync(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     await query.answer()
     
     try:
-        # Reload local data
-        bot.load_local_inventory()
+        # Upload inventory together with anything still waiting in the sync queue
+        bot.queue_sync('inventory')
+        success = bot.drive_service is not None and await run_io(bot.sync_worker.flush, timeout=2 * GOOGLE_HTTP_TIMEOUT + 30)
         
-        # Upload to Google Sheet
-        success = bot.update_google_sheet()
+        if success:
+            # Pick up edits made directly in the sheets, the same way as at start-up:
+            # under the lock, and not over changes that arrived after the flush
+            await run_io(bot.pull_from_drive, timeout=4 * GOOGLE_HTTP_TIMEOUT + 30)
+        
+        await run_io(bot.refresh_images)
         
         if success:
             await query.edit_message_text(
                 "🎉 **Синхронизация завершена успешно!**\n\n"
-                f"📊 **Загружено:** {len(bot.inventory_data)} инструментов\n"
+                f"📊 **Загружено:** {len(bot.instruments)} инструментов\n"
                 f"🔗 **Google Таблица:** {bot.get_google_sheet_url()}\n\n"
                 "✨ Все данные обновлены в Google Sheets!",
                 reply_markup=InlineKeyboardMarkup([
@@ -1620,9 +2101,11 @@ async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     
     keyboard = [
         [InlineKeyboardButton("📦 Просмотр инвентаря", callback_data="view_inventory")],
+        [InlineKeyboardButton("📋 Таблица инвентаря", callback_data="view_table")],
         [InlineKeyboardButton("🔍 Поиск инструментов", callback_data="search_instruments")],
         [InlineKeyboardButton("🆕 Добавить инструмент", callback_data="add_new_instrument")],
         [InlineKeyboardButton("📜 История изменений", callback_data="view_history")],
+        [InlineKeyboardButton("📊 Статистика", callback_data="statistics")],
         [InlineKeyboardButton("🔗 Ссылка на таблицу", callback_data="show_sheet_link")],
         [InlineKeyboardButton("🔄 Синхронизация", callback_data="force_sync")]
     ]
@@ -1642,32 +2125,18 @@ async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         parse_mode='Markdown'
     )
 
-async def view_inventory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Show inventory menu with instrument buttons (paginated)"""
-    query = update.callback_query
-    await query.answer()
-    
-    # Get page number from callback data or default to 0
-    page = 0
-    if query.data.startswith("page_"):
-        page = int(query.data.split("_")[1])
-    
-    # Use local inventory data
-    inventory_data = bot.inventory_data
-    
-    if inventory_data is None or inventory_data.empty:
-        await query.edit_message_text("❌ Данные инвентаря не найдены. Проверьте локальный Excel файл.")
-        return
-    
-    # Filter valid instruments
-    valid_instruments = []
-    for idx, row in inventory_data.iterrows():
-        instrument_name = bot.safe_get_text(row, 1) if len(row) > 1 else bot.safe_get_text(row, 0)
-        if instrument_name and instrument_name != 'nan' and instrument_name != 'None':
-            valid_instruments.append((idx, instrument_name))
+def inventory_page_rows():
+    """(number, name) of every listable instrument, collected once per inventory_version"""
+    return cached_page('inventory_rows', 0, lambda _: [
+        (instrument.number, instrument.name.strip()) for instrument in bot.instruments.ordered()
+        if instrument.name.strip() and instrument.name.strip() not in ('nan', 'None')
+    ])
+
+def render_inventory_page(page: int):
+    valid_instruments = inventory_page_rows()
     
     # Calculate pagination
-    instruments_per_page = 5
+    instruments_per_page = INVENTORY_BUTTONS_PER_PAGE
     total_pages = (len(valid_instruments) + instruments_per_page - 1) // instruments_per_page
     start_idx = page * instruments_per_page
     end_idx = min(start_idx + instruments_per_page, len(valid_instruments))
@@ -1675,10 +2144,10 @@ async def view_inventory(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Create buttons for current page
     keyboard = []
     for i in range(start_idx, end_idx):
-        idx, instrument_name = valid_instruments[i]
+        number, instrument_name = valid_instruments[i]
         keyboard.append([InlineKeyboardButton(
             f"🔧 {instrument_name}", 
-            callback_data=f"instrument_{idx}"
+            callback_data=f"instrument_{number}"
         )])
     
     # Add pagination buttons
@@ -1694,117 +2163,163 @@ async def view_inventory(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Add back button
     keyboard.append([InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")])
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     page_info = f" (Страница {page + 1} из {total_pages})" if total_pages > 1 else ""
-    await query.edit_message_text(
+    text = (
         f"📦 **Управление инвентарем**{page_info}\n\n"
         f"Показано инструментов {start_idx + 1}-{end_idx} из {len(valid_instruments)}\n\n"
-        "Выберите инструмент для просмотра деталей:",
-        reply_markup=reply_markup,
-        parse_mode='Markdown'
+        "Выберите инструмент для просмотра деталей:"
     )
+    return text, InlineKeyboardMarkup(keyboard)
 
-async def show_instrument_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Show detailed information about a specific instrument"""
+async def view_inventory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show inventory menu with instrument buttons (paginated)"""
     query = update.callback_query
     await query.answer()
     
-    instrument_idx = int(query.data.split('_')[1])
-    inventory_data = bot.inventory_data
+    # Get page number from callback data or default to 0
+    page = 0
+    if query.data.startswith("page_"):
+        page = int(query.data.split("_")[1])
+    
+    # Use local inventory data
+    instruments = bot.instruments
     
-    if inventory_data is None or inventory_data.empty:
-        await query.edit_message_text("❌ Данные инвентаря недоступны.")
+    if not instruments:
+        await query.edit_message_text("❌ Данные инвентаря не найдены. Проверьте локальный Excel файл.")
         return
     
-    row = inventory_data.iloc[instrument_idx]
-    instrument_name = bot.safe_get_text(row, 1) if len(row) > 1 else bot.safe_get_text(row, 0)  # Наименование column
-    amount = bot.safe_get_text(row, 5, "0")  # Количество column
+    # Pages are rendered once per inventory version: paging is a cache lookup
+    page = clamp_page(page, len(inventory_page_rows()), INVENTORY_BUTTONS_PER_PAGE)
+    text, reply_markup = cached_page('inventory', page, render_inventory_page)
+    await query.edit_message_text(
+        text,
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+
+def instrument_info_text(instrument) -> str:
+    """Markdown card of an instrument, shared by the instrument view and inline mode"""
+    instrument_name = instrument.name.strip()
+    amount = format_quantity(instrument.quantity)
     
     # Build info message
     info_text = f"🔧 **{instrument_name}**\n\n"
     info_text += f"📊 **Количество в наличии:** {amount} шт.\n\n"
     
     # Add only specific columns (exclude empty columns A-J)
-    important_columns = ['Наименование', 'Модель', 'Компания производителя', 'Характеристика ', 'Количество']
-    for col in important_columns:
-        if col in inventory_data.columns:
-            col_idx = inventory_data.columns.get_loc(col)
-            if col_idx < len(row):
-                value = str(row.iloc[col_idx]).strip()
-                if value and value != 'nan' and value != '0':
-                    info_text += f"📝 **{col}:** {value}\n"
+    important_columns = [
+        ('Наименование', instrument.name),
+        ('Модель', instrument.model),
+        ('Компания производителя', instrument.manufacturer),
+        ('Характеристика ', instrument.characteristics),
+        ('Количество', amount)
+    ]
+    for col, value in important_columns:
+        value = value.strip()
+        if value and value != 'nan' and value != '0':
+            info_text += f"📝 **{col}:** {value}\n"
+    return info_text
+
+def instrument_thumbnail_url(instrument) -> Optional[str]:
+    """Small JPEG of an instrument's image for inline results, or None"""
+    if IMAGE_SERVER_URL and bot.images.get(instrument.number) is not None:
+        # Resized by image_server.py; Telegram only accepts JPEG thumbnails
+        return f"{IMAGE_SERVER_URL}/image{instrument.number}.jpg?w=160&fmt=jpeg"
+    image_url = instrument.image_url.strip()
+    if image_url.startswith(('http://', 'https://')):
+        return image_url
+    return None
+
+def inline_result(instrument) -> InlineQueryResultArticle:
+    details = ', '.join(value.strip() for value in (instrument.model, instrument.manufacturer)
+                        if value.strip() and value.strip() not in ('nan', '0'))
+    description = f"В наличии: {format_quantity(instrument.quantity)} шт."
+    if details:
+        description += f" · {details}"
+    return InlineQueryResultArticle(
+        id=str(instrument.number),
+        title=instrument.name.strip() or "Неизвестно",
+        description=description,
+        input_message_content=InputTextMessageContent(instrument_info_text(instrument), parse_mode='Markdown'),
+        thumbnail_url=instrument_thumbnail_url(instrument),
+    )
+
+async def handle_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """@bot <query> in any chat: instruments by word prefix, answered from a cache tied to inventory_version"""
+    inline_query = update.inline_query
+    key = normalize_text(inline_query.query)
+    if not key or bot.instruments is None:
+        await inline_query.answer([], cache_time=INLINE_CACHE_SECONDS)
+        return
+    
+    version = bot.inventory_version
+    results = bot.inline_cache.get(key, version)
+    if results is None:
+        instruments = bot.instruments.lookup(inline_query.query, INLINE_RESULT_LIMIT)
+        results = [inline_result(instrument) for instrument in instruments]
+        # Answers from the name scan used before the indexes are ready are not kept
+        if bot.instruments.indexed:
+            bot.inline_cache.put(key, version, results)
+    
+    try:
+        offset = int(inline_query.offset or 0)
+    except ValueError:
+        offset = 0
+    page = results[offset:offset + INLINE_PAGE_SIZE]
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(results) else ''
+    await inline_query.answer(page, cache_time=INLINE_CACHE_SECONDS, next_offset=next_offset)
+
+async def show_instrument_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show detailed information about a specific instrument"""
+    query = update.callback_query
+    await query.answer()
+    
+    instrument_number = query.data.split('_')[1]
+    instruments = bot.instruments
+    
+    if not instruments:
+        await query.edit_message_text("❌ Данные инвентаря недоступны.")
+        return
+    
+    instrument = instruments.get(instrument_number)
+    if instrument is None:
+        await query.edit_message_text("❌ Инструмент не найден.")
+        return
+    info_text = instrument_info_text(instrument)
     
     # Try to find and send image
     image_sent = False
     try:
         # First check for ImageURL column
-        if 'ImageURL' in inventory_data.columns:
-            image_url_idx = inventory_data.columns.get_loc('ImageURL')
-            if image_url_idx < len(row):
-                image_url = str(row.iloc[image_url_idx]).strip()
-                if image_url and image_url != 'nan' and image_url != '':
-                    logger.info(f"Found image URL: {image_url}")
-                    try:
-                        await query.message.reply_photo(
-                            photo=image_url,
-                            caption=info_text,
-                            parse_mode='Markdown'
-                        )
-                        image_sent = True
-                        logger.info(f"Successfully sent image from URL: {image_url}")
-                    except Exception as e:
-                        logger.error(f"Failed to send image from URL {image_url}: {e}")
-                        info_text += f"🖼️ **Изображение:** [Ссылка]({image_url})\n"
-        
-        # If no ImageURL or failed, try local files
+        image_url = instrument.image_url.strip()
+        if image_url and image_url != 'nan':
+            logger.info(f"Found image URL: {image_url}")
+            # The URL alone does not name the bytes behind it: key on the instrument's stored image
+            # (what the image server returns for it), or on the data version when there is none
+            stored = bot.images.reference(instrument.number)
+            content = stored.digest if stored else f"v{bot.inventory_version}"
+            try:
+                await reply_cached(query.message, 'photo', f"photo:url:{content}:{image_url}", url=image_url,
+                                   caption=info_text, parse_mode='Markdown')
+                image_sent = True
+                logger.info(f"Successfully sent image from URL: {image_url}")
+            except Exception as e:
+                logger.error(f"Failed to send image from URL {image_url}: {e}")
+                info_text += f"🖼️ **Изображение:** [Ссылка]({image_url})\n"
+        
+        # If no ImageURL or failed, use the local image from the manifest
         if not image_sent:
-            # Use the instrument number from the "№" column to match image names
-            instrument_number = str(int(row.iloc[0])) if len(row) > 0 and pd.notna(row.iloc[0]) else str(instrument_idx + 1)
-            
-            # Try local file first (since we have images locally)
-            if instrument_number:
-                # Try different image formats
-                image_paths = [
-                    f"image{instrument_number}.png",
-                    f"image{instrument_number}.jpg", 
-                    f"image{instrument_number}.jpeg",
-                    f"image{instrument_number}.avif"
-                ]
-                
-                for image_path in image_paths:
-                    if os.path.exists(image_path):
-                        logger.info(f"Found local image: {image_path}")
-                        try:
-                            # Send image first
-                            with open(image_path, 'rb') as photo:
-                                await query.message.reply_photo(photo=photo, caption=info_text, parse_mode='Markdown')
-                            image_sent = True
-                            logger.info(f"Successfully sent image: {image_path}")
-                            break
-                        except Exception as img_error:
-                            logger.error(f"Failed to send image {image_path}: {img_error}")
-                            # If it's an AVIF file that failed, try to convert it
-                            if image_path.endswith('.avif'):
-                                try:
-                                    # Try to convert AVIF to PNG using a simple approach
-                                    import subprocess
-                                    png_path = image_path.replace('.avif', '_converted.png')
-                                    # Use sips (macOS built-in) to convert
-                                    result = subprocess.run(['sips', '-s', 'format', 'png', image_path, '--out', png_path], 
-                                                          capture_output=True, text=True)
-                                    if result.returncode == 0 and os.path.exists(png_path):
-                                        logger.info(f"Converted AVIF to PNG: {png_path}")
-                                        with open(png_path, 'rb') as photo:
-                                            await query.message.reply_photo(photo=photo, caption=info_text, parse_mode='Markdown')
-                                        image_sent = True
-                                        logger.info(f"Successfully sent converted image: {png_path}")
-                                        # Clean up converted file
-                                        os.remove(png_path)
-                                        break
-                                except Exception as convert_error:
-                                    logger.error(f"Failed to convert AVIF: {convert_error}")
-                            continue
+            image = bot.images.variant(instrument.number, 'telegram')
+            if image is not None:
+                image_path, image_key = image
+                try:
+                    # Send the pre-optimized image (by file_id once Telegram has it)
+                    await reply_cached(query.message, 'photo', f"photo:{image_key}", path=image_path,
+                                       caption=info_text, parse_mode='Markdown')
+                    image_sent = True
+                    logger.info(f"Successfully sent image: {image_path}")
+                except Exception as img_error:
+                    logger.error(f"Failed to send image {image_path}: {img_error}")
     except Exception as e:
         logger.error(f"Error processing image: {e}")
     
@@ -1814,8 +2329,8 @@ async def show_instrument_info(update: Update, context: ContextTypes.DEFAULT_TYP
         info_text += f"\n🖼️ **Изображение:** Недоступно"
         
         keyboard = [
-            [InlineKeyboardButton("✏️ Изменить количество", callback_data=f"edit_{instrument_idx}")],
-            [InlineKeyboardButton("🗑️ Удалить инструмент", callback_data=f"delete_{instrument_idx}")],
+            [InlineKeyboardButton("✏️ Изменить количество", callback_data=f"edit_{instrument.number}")],
+            [InlineKeyboardButton("🗑️ Удалить инструмент", callback_data=f"delete_{instrument.number}")],
             [InlineKeyboardButton("🔙 Назад к инвентарю", callback_data="view_inventory")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1828,8 +2343,8 @@ async def show_instrument_info(update: Update, context: ContextTypes.DEFAULT_TYP
     else:
         # Image was sent successfully, just add the keyboard buttons
         keyboard = [
-            [InlineKeyboardButton("✏️ Изменить количество", callback_data=f"edit_{instrument_idx}")],
-            [InlineKeyboardButton("🗑️ Удалить инструмент", callback_data=f"delete_{instrument_idx}")],
+            [InlineKeyboardButton("✏️ Изменить количество", callback_data=f"edit_{instrument.number}")],
+            [InlineKeyboardButton("🗑️ Удалить инструмент", callback_data=f"delete_{instrument.number}")],
             [InlineKeyboardButton("🔙 Назад к инвентарю", callback_data="view_inventory")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1845,21 +2360,26 @@ async def start_edit_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     query = update.callback_query
     await query.answer()
     
-    instrument_idx = int(query.data.split('_')[1])
-    inventory_data = bot.inventory_data
+    instrument_number = query.data.split('_')[1]
+    instruments = bot.instruments
     
-    if inventory_data is None or inventory_data.empty:
+    if not instruments:
         await query.edit_message_text("❌ Данные инвентаря недоступны.")
         return
     
-    instrument_name = str(inventory_data.iloc[instrument_idx].iloc[1]).strip() if len(inventory_data.iloc[instrument_idx]) > 1 else str(inventory_data.iloc[instrument_idx].iloc[0]).strip()
-    current_amount = str(inventory_data.iloc[instrument_idx].iloc[5]).strip() if len(inventory_data.iloc[instrument_idx]) > 5 else "0"
+    instrument = instruments.get(instrument_number)
+    if instrument is None:
+        await query.edit_message_text("❌ Инструмент не найден.")
+        return
+    
+    instrument_name = instrument.name.strip()
+    current_amount = format_quantity(instrument.quantity)
     
-    # Store the instrument index in context for the next message
-    context.user_data['editing_instrument'] = instrument_idx
+    # Store the instrument number in context for the next message
+    context.user_data['editing_instrument'] = instrument.number
     
     keyboard = [
-        [InlineKeyboardButton("❌ Отмена", callback_data=f"instrument_{instrument_idx}")]
+        [InlineKeyboardButton("❌ Отмена", callback_data=f"instrument_{instrument.number}")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -1879,7 +2399,7 @@ async def handle_amount_update(update: Update, context: ContextTypes.DEFAULT_TYP
         return
     
     new_amount = update.message.text.strip()
-    instrument_idx = context.user_data['editing_instrument']
+    instrument_number = context.user_data['editing_instrument']
     
     # Validate the amount (basic validation)
     try:
@@ -1888,28 +2408,31 @@ async def handle_amount_update(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("❌ Введите корректное число для количества.")
         return
     
-    inventory_data = bot.inventory_data
-    if inventory_data is None or inventory_data.empty:
-        await update.message.reply_text("⚠️ Данные инвентаря недоступны.")
+    instruments = bot.instruments
+    instrument = instruments.get(instrument_number) if instruments else None
+    if instrument is None:
+        await update.message.reply_text("⚠️ Инструмент не найден. Возможно, он был удален.")
+        del context.user_data['editing_instrument']
         return
     
-    instrument_name = str(inventory_data.iloc[instrument_idx].iloc[1]).strip() if len(inventory_data.iloc[instrument_idx]) > 1 else str(inventory_data.iloc[instrument_idx].iloc[0]).strip()
+    instrument_name = instrument.name.strip()
     
     # Get old amount before updating
-    old_amount = str(inventory_data.iloc[instrument_idx].iloc[5]).strip()  # Количество is column index 5
+    old_amount = format_quantity(instrument.quantity)
     
-    # Update the amount in Google Sheets
-    success = bot.update_instrument_amount(instrument_name, new_amount)
+    # Update the amount (saved locally, synced to Google Drive in the background)
+    try:
+        success = await run_io(bot.set_instrument_amount, instrument.number, new_amount, timeout=None)
+    except asyncio.TimeoutError:
+        logger.error(f"Timed out updating amount of {instrument_name}")
+        success = False
     
     if success:
-        # Reload data to get fresh information
-        bot.load_local_inventory()
-        
         # Log the change with old and new amounts
         user_id = update.effective_user.id
         username = update.effective_user.username or update.effective_user.first_name or f"User {user_id}"
         logger.info(f"About to log history: user={username}, instrument={instrument_name}, change={old_amount}->{new_amount}")
-        log_change(user_id, username, "Изменение количества", instrument_name, f"{old_amount} шт. → {new_amount} шт.")
+        await run_io(log_change, user_id, username, "Изменение количества", instrument_name, f"{old_amount} шт. → {new_amount} шт.", timeout=None)
         logger.info("History log call returned")
         
         keyboard = [
@@ -1938,26 +2461,27 @@ async def delete_instrument(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     
-    instrument_idx = int(query.data.split('_')[1])
-    inventory_data = bot.inventory_data
+    instrument_number = query.data.split('_')[1]
+    instruments = bot.instruments
     
-    if inventory_data is None or inventory_data.empty:
+    if not instruments:
         await query.edit_message_text("❌ Данные инвентаря недоступны.")
         return
     
-    if instrument_idx >= len(inventory_data):
+    instrument = instruments.get(instrument_number)
+    if instrument is None:
         await query.edit_message_text("❌ Инструмент не найден.")
         return
     
     # Get instrument name for confirmation
-    instrument_name = str(inventory_data.iloc[instrument_idx].iloc[1]).strip() if len(inventory_data.iloc[instrument_idx]) > 1 else str(inventory_data.iloc[instrument_idx].iloc[0]).strip()
+    instrument_name = instrument.name.strip()
     
-    # Store the instrument index for confirmation
-    context.user_data['deleting_instrument'] = instrument_idx
+    # Store the instrument number for confirmation
+    context.user_data['deleting_instrument'] = instrument.number
     
     keyboard = [
-        [InlineKeyboardButton("✅ Да, удалить", callback_data=f"confirm_delete_{instrument_idx}")],
-        [InlineKeyboardButton("❌ Отмена", callback_data=f"instrument_{instrument_idx}")]
+        [InlineKeyboardButton("✅ Да, удалить", callback_data=f"confirm_delete_{instrument.number}")],
+        [InlineKeyboardButton("❌ Отмена", callback_data=f"instrument_{instrument.number}")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -1976,34 +2500,30 @@ async def confirm_delete_instrument(update: Update, context: ContextTypes.DEFAUL
     query = update.callback_query
     await query.answer()
     
-    instrument_idx = int(query.data.split('_')[2])
-    inventory_data = bot.inventory_data
+    instrument_number = query.data.split('_')[2]
+    instruments = bot.instruments
     
-    if inventory_data is None or inventory_data.empty:
+    if not instruments:
         await query.edit_message_text("❌ Данные инвентаря недоступны.")
         return
     
-    if instrument_idx >= len(inventory_data):
+    instrument = instruments.get(instrument_number)
+    if instrument is None:
         await query.edit_message_text("❌ Инструмент не найден.")
         return
     
     # Get instrument name before deletion
-    instrument_name = str(inventory_data.iloc[instrument_idx].iloc[1]).strip() if len(inventory_data.iloc[instrument_idx]) > 1 else str(inventory_data.iloc[instrument_idx].iloc[0]).strip()
+    instrument_name = instrument.name.strip()
     
     try:
-        # Delete the row from DataFrame
-        bot.inventory_data = inventory_data.drop(inventory_data.index[instrument_idx]).reset_index(drop=True)
-        
-        # Save to local Excel file
-        bot.save_local_inventory()
-        
-        # Update Google Sheet
-        bot.update_google_sheet()
+        # Delete the row, save and sync in a single commit
+        if not await run_io(bot.delete_instrument, instrument.number, timeout=None):
+            raise RuntimeError("не удалось удалить инструмент")
         
         # Log the change
         user_id = update.effective_user.id
         username = update.effective_user.username or update.effective_user.first_name or f"User {user_id}"
-        log_change(user_id, username, "Удаление инструмента", instrument_name, "удаление инструмента")
+        await run_io(log_change, user_id, username, "Удаление инструмента", instrument_name, "удаление инструмента", timeout=None)
         
         # Clear user data
         if 'deleting_instrument' in context.user_data:
@@ -2190,14 +2710,29 @@ async def add_back_to_characteristics(update: Update, context: ContextTypes.DEFA
             parse_mode='Markdown'
         )
 
+# Callbacks that change data (or upload it); refused until the start-up reconciliation has finished
+EDIT_CALLBACKS = ("edit_", "delete_", "confirm_delete_", "add_new_instrument", "save_instrument", "force_sync")
+
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle all callback queries"""
     query = update.callback_query
     
+    if query.data.startswith(EDIT_CALLBACKS) and not bot.reconciled.is_set():
+        await query.answer("⏳ Идёт сверка данных с Google Drive. Изменения будут доступны через минуту.", show_alert=True)
+        return
+    
     if query.data == "view_inventory":
         await view_inventory(update, context)
     elif query.data.startswith("page_"):
         await view_inventory(update, context)
+    elif query.data == "view_table" or query.data.startswith("table_page_"):
+        await view_table(update, context)
+    elif query.data == "statistics":
+        await statistics(update, context)
+    elif query.data == "chart_manufacturers":
+        await chart_manufacturers(update, context)
+    elif query.data == "chart_stock":
+        await chart_stock(update, context)
     elif query.data == "search_instruments":
         await search_instruments(update, context)
     elif query.data.startswith("search_page_"):
@@ -2397,12 +2932,16 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 def main():
     """Main function to run the bot"""
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Create application; in-memory inventory changes are applied on its event loop
+    async def attach_loop(application: Application) -> None:
+        bot.attach_loop(asyncio.get_running_loop())
+    
+    application = Application.builder().token(BOT_TOKEN).post_init(attach_loop).build()
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CallbackQueryHandler(handle_callback_query))
+    application.add_handler(InlineQueryHandler(handle_inline_query))  # Inline mode must be enabled in @BotFather
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
     application.add_handler(MessageHandler(filters.PHOTO, handle_text_message))  # Обработка изображений
     
@@ -2410,7 +2949,12 @@ def main():
     
     # Start the bot
     logger.info("Starting Telegram bot...")
-    application.run_polling()
+    try:
+        application.run_polling()
+    finally:
+        # Upload edits still waiting for their debounce window
+        bot.sync_worker.stop()
+        executors.shutdown()
 
 if __name__ == '__main__':
     main()